@@ -0,0 +1,116 @@
+# agent/backpressure.py
+
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+logger = logging.getLogger(__name__)
+
+# Failures that mean the provider is struggling, as opposed to a bad request of ours
+# (APITimeoutError is an APIConnectionError)
+OVERLOAD_ERRORS = (RateLimitError, APIConnectionError, InternalServerError, asyncio.TimeoutError)
+
+
+class AIMDController:
+    """
+    Adaptive cap on concurrent LLM calls (additive increase, multiplicative
+    decrease, as in TCP congestion control).
+
+    After each call the average latency of the last window calls is checked:
+    while it stays within target_latency the cap grows by increase, and when
+    it goes above, or a call fails with an overload error, the cap is
+    multiplied by decrease. Calls over the cap wait their turn in FIFO order,
+    so under provider stress fewer requests are in flight instead of all of
+    them timing out together.
+
+    Args:
+        min_limit: Lowest concurrency cap
+        max_limit: Highest concurrency cap
+        target_latency: Average call latency (seconds) the cap is steered to
+        window: Number of recent call latencies averaged
+        increase: Added to the cap after a fast, successful call
+        decrease: Factor applied to the cap after a slow or failed call
+    """
+
+    def __init__(
+        self,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        target_latency: float = 3.0,
+        window: int = 32,
+        increase: float = 0.5,
+        decrease: float = 0.5
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._latencies: deque = deque(maxlen=window)
+        # Futures of calls waiting for a slot, oldest first
+        self._waiters: deque = deque()
+
+    @asynccontextmanager
+    async def admit(self):
+        """Hold one concurrency slot for the duration of the block."""
+        await self._acquire()
+        started = time.monotonic()
+        try:
+            yield
+        except OVERLOAD_ERRORS:
+            self._release(time.monotonic() - started, failed=True)
+            raise
+        except BaseException:
+            # Cancellations and our own bugs say nothing about the provider
+            self._release(None, failed=False)
+            raise
+        else:
+            self._release(time.monotonic() - started, failed=False)
+
+    async def _acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we were cancelled; pass it on
+                self.in_flight -= 1
+                self._wake()
+            elif waiter in self._waiters:
+                # Still queued; a _wake that ran since the cancel has already dropped it otherwise
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self, latency, failed: bool) -> None:
+        self.in_flight -= 1
+
+        if latency is not None:
+            self._latencies.append(latency)
+            if failed or statistics.mean(self._latencies) > self.target_latency:
+                self.limit = max(float(self.min_limit), self.limit * self.decrease)
+                logger.debug(f"LLM concurrency cap lowered to {int(self.limit)}")
+            else:
+                self.limit = min(float(self.max_limit), self.limit + self.increase)
+
+        self._wake()
+
+    def _wake(self) -> None:
+        """Hand free slots to waiting calls, oldest first."""
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
@@ -0,0 +1,145 @@
+# agent/cache.py
+
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """
+    LRU cache of triage results keyed by the embedding of the ticket description.
+
+    A lookup returns the cached result whose embedding is most similar to the
+    query embedding, as long as the cosine similarity reaches the threshold, so
+    near-duplicate tickets ("reset password" bursts) skip the KB search and LLM.
+
+    Results stored with a text_key (see text_key()) can also be found by it
+    with get_exact(), a dict lookup that needs no embedding at all.
+
+    Args:
+        max_size: Maximum number of cached results
+        ttl: Seconds before a cached result expires
+        threshold: Minimum cosine similarity for a cache hit
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600, threshold: float = 0.97):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        # key -> (unit-length embedding, value, expires_at, text_key)
+        self._entries: OrderedDict = OrderedDict()
+        # text_key -> key, for exact repeats of a description
+        self._by_text: Dict[str, str] = {}
+        # Stacked embeddings of all entries, rebuilt lazily after changes
+        self._keys: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, embedding: List[float]) -> Optional[Any]:
+        """Return the cached value for the nearest embedding, or None on a miss."""
+        query = self._normalize(embedding)
+        if query is None:
+            return None
+
+        self._evict_expired()
+        if not self._entries:
+            return None
+
+        if self._matrix is None:
+            self._keys = list(self._entries)
+            self._matrix = np.stack([self._entries[key][0] for key in self._keys])
+
+        scores = self._matrix @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+
+        key = self._keys[best]
+        self._entries.move_to_end(key)
+        logger.debug(f"Semantic cache hit (similarity {scores[best]:.3f})")
+        return self._entries[key][1]
+
+    def get_exact(self, text_key: str) -> Optional[Any]:
+        """Return the value cached for exactly this text, or None on a miss."""
+        key = self._by_text.get(text_key)
+        if key is None:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is None or entry[2] <= time.monotonic() or entry[3] != text_key:
+            # Evicted, expired, or overwritten under another text
+            self._by_text.pop(text_key, None)
+            return None
+
+        self._entries.move_to_end(key)
+        logger.debug("Exact cache hit")
+        return entry[1]
+
+    def put(self, embedding: List[float], value: Any, text_key: Optional[str] = None, ttl: Optional[float] = None) -> None:
+        """Cache a value under the given embedding and, if given, text_key."""
+        vector = self._normalize(embedding)
+        if vector is None:
+            # Zero vectors come from failed embedding calls and would match nothing
+            return
+
+        key = self._key(vector)
+        self._entries[key] = (vector, value, time.monotonic() + (self.ttl if ttl is None else ttl), text_key)
+        self._entries.move_to_end(key)
+        if text_key is not None:
+            self._by_text[text_key] = key
+
+        while len(self._entries) > self.max_size:
+            evicted, entry = self._entries.popitem(last=False)
+            self._forget_text(entry[3], evicted)
+
+        self._matrix = None
+
+    def items(self) -> Iterator[Tuple[np.ndarray, Any, float, Optional[str]]]:
+        """Live entries, least recently used first, as (embedding, value, seconds left, text_key)."""
+        now = time.monotonic()
+        for vector, value, expires_at, text_key in list(self._entries.values()):
+            if expires_at > now:
+                yield vector, value, expires_at - now, text_key
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_text.clear()
+        self._matrix = None
+
+    @staticmethod
+    def text_key(text: str) -> str:
+        """Exact-match key of a text, ignoring case and runs of whitespace."""
+        return hashlib.sha256(" ".join(text.lower().split()).encode()).hexdigest()
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if entry[2] <= now]
+        for key in expired:
+            self._forget_text(self._entries.pop(key)[3], key)
+        if expired:
+            self._matrix = None
+
+    def _forget_text(self, text_key: Optional[str], key: str) -> None:
+        if text_key is not None and self._by_text.get(text_key) == key:
+            del self._by_text[text_key]
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
+
+    @staticmethod
+    def _key(vector: np.ndarray) -> str:
+        # Quantize first so float noise in identical embeddings maps to one key
+        return hashlib.sha256(np.round(vector, 4).tobytes()).hexdigest()
@@ -0,0 +1,69 @@
+# agent/clients.py
+
+from functools import lru_cache
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from app.config import get_settings
+from agent.rate_limiter import EndpointRateLimiters
+
+
+# One pool for every OpenAI call in the process, so keep-alive connections
+# (and their TLS sessions) are reused across chat and embeddings
+_OPENAI_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+
+
+@lru_cache(maxsize=1)
+def get_rate_limiters() -> EndpointRateLimiters:
+    """Client-side OpenAI rate limiters, shared by the sync and async clients."""
+    settings = get_settings()
+    return EndpointRateLimiters(
+        rpm_limit=settings.OPENAI_RPM_LIMIT,
+        tpm_limit=settings.OPENAI_TPM_LIMIT,
+        threshold=settings.RATE_LIMIT_THRESHOLD
+    )
+
+
+@lru_cache(maxsize=1)
+def get_async_openai() -> AsyncOpenAI:
+    """Process-wide AsyncOpenAI client. Retries are ours (retry_with_backoff_async), not the SDK's."""
+    settings = get_settings()
+    return AsyncOpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        timeout=settings.OPENAI_TIMEOUT,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(
+            limits=_OPENAI_LIMITS,
+            timeout=settings.OPENAI_TIMEOUT,
+            event_hooks=get_rate_limiters().async_hooks()
+        )
+    )
+
+
+@lru_cache(maxsize=1)
+def get_openai() -> OpenAI:
+    """Process-wide sync OpenAI client, for code that runs in worker threads."""
+    settings = get_settings()
+    return OpenAI(
+        api_key=settings.OPENAI_API_KEY,
+        timeout=settings.OPENAI_TIMEOUT,
+        max_retries=0,
+        http_client=DefaultHttpxClient(
+            limits=_OPENAI_LIMITS,
+            timeout=settings.OPENAI_TIMEOUT,
+            event_hooks=get_rate_limiters().sync_hooks()
+        )
+    )
+
+
+async def close_openai_clients() -> None:
+    """
+    Close the shared OpenAI clients at shutdown. The caches are cleared too, so
+    a later startup in the same process (another app, a test client) gets new
+    clients rather than closed ones.
+    """
+    if get_async_openai.cache_info().currsize:
+        await get_async_openai().close()
+    if get_openai.cache_info().currsize:
+        get_openai().close()
+    get_async_openai.cache_clear()
+    get_openai.cache_clear()
@@ -0,0 +1,115 @@
+# agent/fast_router.py
+
+import logging
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Same cut-off the triage rubric gives the LLM for calling a ticket a known issue
+KNOWN_ISSUE_SCORE = 0.5
+
+
+class Route(NamedTuple):
+    category: str
+    severity: str
+    team: str  # as named in the rubric's next actions
+    phrases: Tuple[str, ...]
+
+
+# Phrases that point at a single category. Only tickets matching several
+# phrases of one route, and none of another, are routed (see FastRouter).
+# Routed tickets are blockers, which the rubric puts at High at least
+ROUTES = (
+    Route("Billing", "High", "billing", (
+        "credit card", "debit card", "payment method", "subscription", "invoice", "refund", "billing",
+        "charged",
+    )),
+    Route("Login", "High", "auth", (
+        "password", "2fa", "two-factor", "log in", "login", "locked out", "sign in",
+    )),
+)
+
+# A ticket must say it is blocked to be routed; anything else may be a
+# request or a how-to, which the rubric rates lower
+BLOCKERS = (
+    "can't", "cannot", "can not", "unable", "won't", "doesn't work", "not working",
+    "fails", "failed", "failing", "declined", "error", "locked out",
+    "charged twice", "double charged", "overcharged",
+)
+
+# Left to the LLM even when blocked: how-to questions are Low, and problems
+# hitting many users may be Critical
+DEFERRALS = (
+    "how do", "how can", "how to", "where do", "where can", "where is", "is it possible",
+    "all users", "many users", "all customers", "everyone", "outage",
+)
+
+
+def _any_of(phrases: Tuple[str, ...]) -> re.Pattern:
+    # Longest first, so "two-factor" isn't cut short by a shorter phrase
+    phrases = sorted(phrases, key=len, reverse=True)
+    return re.compile(
+        r"\b(?:" + "|".join(re.escape(phrase) for phrase in phrases) + r")\b",
+        re.IGNORECASE
+    )
+
+
+class FastRouter:
+    """
+    Keyword router that classifies unambiguous tickets without an LLM call.
+
+    All phrases are compiled into one case-insensitive alternation, so a
+    ticket is scanned once however many routes there are. A ticket is routed
+    when it matches at least min_matches distinct phrases of one route and no
+    phrase of any other, says it is blocked, and is neither a question nor a
+    wide outage; anything less clear-cut is left to the LLM.
+
+    Args:
+        routes: Categories with their phrases
+        min_matches: Distinct phrases of one route needed to route a ticket
+    """
+
+    def __init__(self, routes: Tuple[Route, ...] = ROUTES, min_matches: int = 2):
+        self.min_matches = min_matches
+        self._route_of: Dict[str, Route] = {
+            phrase: route for route in routes for phrase in route.phrases
+        }
+        self._pattern = _any_of(tuple(self._route_of))
+        self._blockers = _any_of(BLOCKERS)
+        self._deferrals = _any_of(DEFERRALS)
+
+    def match(self, description: str) -> Optional[Route]:
+        """Return the route the description clearly belongs to, or None."""
+        hits = {phrase.lower() for phrase in self._pattern.findall(description)}
+        routes = {self._route_of[phrase] for phrase in hits}
+        if len(routes) != 1 or len(hits) < self.min_matches:
+            return None
+        if "?" in description or self._deferrals.search(description) or not self._blockers.search(description):
+            return None
+        return routes.pop()
+
+    def classify(self, route: Route, description: str, kb_hits: List[Dict]) -> dict:
+        """Build the classification of a routed ticket from its route and KB hits."""
+        # A hit from another category is not a match, as in the rubric
+        known = next(
+            (
+                hit for hit in kb_hits
+                if hit["score"] > KNOWN_ISSUE_SCORE and hit.get("category") == route.category
+            ),
+            None
+        )
+        summary = " ".join(description.split())
+        if len(summary) > 100:
+            summary = summary[:97] + "..."
+
+        return {
+            "summary": summary,
+            "category": route.category,
+            "severity": route.severity,
+            "issue_type": "known_issue" if known else "new_issue",
+            "next_action": (
+                f"Escalate to {route.team} team; link to {known['id']}" if known
+                else f"Escalate to {route.team} team"
+            )
+        }
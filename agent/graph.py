@@ -1,13 +1,24 @@
-from typing import TypedDict, Annotated, Literal
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TypedDict, Annotated, Literal, List, Dict, NamedTuple
+from openai import OpenAI, AsyncOpenAI
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 from langgraph.checkpoint.memory import MemorySaver
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from agent.tools import search_knowledge_base, classify_ticket
-from agent.utils import retry_with_backoff, handle_llm_error, LLMError
+from langchain_core.utils.function_calling import convert_to_openai_function
+from langchain_core.runnables import Runnable
+from agent.tools import kb, format_kb_results
+from agent.models import TriageClassification, BatchClassification
+from agent.prompts import TRIAGE_SYSTEM_PROMPT, BATCH_TRIAGE_SYSTEM_PROMPT, get_ticket_message
+from agent.utils import retry_with_backoff_async, handle_llm_error, LLMError
+from agent.backpressure import AIMDController
 from app.config import get_settings
+from agent.clients import get_openai, get_async_openai
 import logging
+import threading
+import orjson
 
 logger = logging.getLogger(__name__)
 
@@ -23,12 +34,67 @@ class AgentState(TypedDict):
 
 settings = get_settings()
 
+def _response_format(schema) -> dict:
+    """OpenAI structured outputs response_format that forces JSON matching the schema."""
+    function = convert_to_openai_function(schema, strict=True)
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": function["name"],
+            "description": function["description"],
+            "strict": True,
+            "schema": function["parameters"]
+        }
+    }
+
+
+# Caps concurrent LLM calls, backing off while the provider is slow or failing
+_CONCURRENCY = AIMDController(
+    min_limit=settings.LLM_CONCURRENCY_MIN,
+    max_limit=settings.LLM_CONCURRENCY_MAX,
+    target_latency=settings.LLM_TARGET_LATENCY
+)
+
+class _Models(NamedTuple):
+    classify: Runnable
+    classify_batch: Runnable
+
+
+@lru_cache(maxsize=1)
+def _build_models(client: OpenAI, async_client: AsyncOpenAI) -> _Models:
+    """
+    Chat models on the process-wide OpenAI clients, so chat and embeddings
+    share one connection pool, and every call reuses the same response schema.
+    Rebuilt only when the clients are (after close_openai_clients()).
+    """
+    llm = ChatOpenAI(
+        model=settings.OPENAI_MODEL,
+        api_key=settings.OPENAI_API_KEY,
+        temperature=settings.OPENAI_TEMPERATURE,
+        timeout=settings.OPENAI_TIMEOUT,
+        max_retries=0,  # We handle retries ourselves
+        client=client.chat.completions,
+        async_client=async_client.chat.completions,
+        root_client=client,
+        root_async_client=async_client
+    )
+    return _Models(
+        classify=llm.bind(response_format=_response_format(TriageClassification)),
+        classify_batch=llm.bind(response_format=_response_format(BatchClassification))
+    )
+
 
-def search_kb_node(state: AgentState):
+def get_models() -> _Models:
+    return _build_models(get_openai(), get_async_openai())
+
+
+async def search_kb_node(state: AgentState):
     messages = state["messages"]
     user_query = messages[-1].content
     
-    kb_results = search_knowledge_base.invoke({"query": user_query})
+    # Called directly rather than through the search_knowledge_base tool, which
+    # adds argument validation and callback overhead on every ticket
+    kb_results = format_kb_results(await kb.asearch(user_query, top_k=3))
     
     return {
         "kb_results": kb_results,
@@ -36,152 +102,64 @@ def search_kb_node(state: AgentState):
     }
 
 
-@retry_with_backoff()
-def call_llm_with_retry(llm, messages):
-    """Wrapper function for LLM calls with retry logic."""
-    return llm.invoke(messages)
+@retry_with_backoff_async()
+async def call_llm_with_retry(llm, messages):
+    """Wrapper function for LLM calls with retry logic and admission control."""
+    # Each attempt is admitted separately, so backoff sleeps don't hold a slot
+    async with _CONCURRENCY.admit():
+        return await llm.ainvoke(messages)
 
 
-def analyze_node(state: AgentState):
-    """Analyze if we need more information from the user."""
-    kb_results = state.get("kb_results", "")
-    user_query = state["messages"][0].content
-    additional_details = state.get("additional_details", "")
-    
-    # Build context with additional details if provided
-    full_context = user_query
-    if additional_details:
-        full_context += f"\n\nAdditional details provided by user:\n{additional_details}"
-    
-    try:
-        llm = ChatOpenAI(
-            model=settings.OPENAI_MODEL,
-            api_key=settings.OPENAI_API_KEY,
-            temperature=settings.OPENAI_TEMPERATURE,
-            timeout=settings.OPENAI_TIMEOUT,
-            max_retries=0  # We handle retries ourselves
-        )
-        
-        # First, check if we need more information
-        analysis_prompt = f"""Analyze this support ticket and determine if you have enough information to match it with the knowledge base results.
-
-Ticket: {full_context}
-
-{kb_results}
-
-Your task:
-1. Look at the knowledge base results above
-2. Determine if you can confidently match the ticket to one of the known issues OR classify it as a new issue
-3. Only ask for more information if:
-   - The ticket is extremely vague (e.g., "something is broken", "not working")
-   - You cannot determine which category it belongs to
-   - The description is so unclear that you're unsure if it matches any KB entry or not
-
-If you have enough information to proceed (even if no KB match is found), respond with:
-PROCEED
+def fallback_classification(summary: str, next_action: str) -> dict:
+    """Classification used when the LLM could not classify a ticket."""
+    return {
+        "summary": summary,
+        "category": "Bug",
+        "severity": "Medium",
+        "issue_type": "new_issue",
+        "next_action": next_action
+    }
 
-If you genuinely need more information to determine relevance to KB or categorize, respond with:
-NEED_MORE_INFO: <specific question to ask the user>
 
-Examples:
-- "App is slow" -> PROCEED (can classify as Performance, even without exact KB match)
-- "Getting error 500 on checkout" -> PROCEED (specific enough, clear category)
-- "Login not working" -> PROCEED (clear category, can match or escalate)
-- "Something is broken" -> NEED_MORE_INFO: What exactly isn't working? Can you describe which feature or page you're having trouble with?
-- "Issue" -> NEED_MORE_INFO: Can you please describe the issue you're experiencing? What were you trying to do when the problem occurred?
-- "Help" -> NEED_MORE_INFO: What do you need help with? Please describe your question or issue.
-- "Mobile error" -> PROCEED (vague but has context - mobile + error, can classify)
+async def classify_node(state: AgentState):
+    """Classify the ticket, or ask a clarifying question if it is too vague.
 
-Only interrupt if the ticket provides NO actionable information."""
-        
-        analysis_response = call_llm_with_retry(llm, [SystemMessage(content=analysis_prompt)])
-        content = analysis_response.content.strip()
-        
-        if content.startswith("NEED_MORE_INFO:"):
-            question = content.replace("NEED_MORE_INFO:", "").strip()
-            return {
-                "needs_more_info": True,
-                "interrupt_question": question,
-                "messages": [AIMessage(content=f"🤔 I need more information to properly classify this ticket.\n\nQuestion: {question}")]
-            }
-        else:
-            return {
-                "needs_more_info": False,
-                "messages": [AIMessage(content="Proceeding with classification...")]
-            }
-    
-    except LLMError as e:
-        logger.error(f"LLM error in analyze_node: {e}")
-        error_info = handle_llm_error(e)
-        return {
-            "needs_more_info": False,
-            "messages": [AIMessage(content=f"⚠️ Error analyzing ticket: {error_info['message']}. Proceeding with best-effort classification.")]
-        }
-    
-    except Exception as e:
-        logger.error(f"Unexpected error in analyze_node: {e}", exc_info=True)
-        return {
-            "needs_more_info": False,
-            "messages": [AIMessage(content="⚠️ An error occurred during analysis. Proceeding with classification...")]
-        }
-
-
-def classify_node(state: AgentState):
+    Deciding whether more information is needed and classifying the ticket
+    happen in the same LLM call, so the KB context is only sent once.
+    """
     kb_results = state.get("kb_results", "")
     user_query = state["messages"][0].content
     additional_details = state.get("additional_details", "")
     
-    # Build full context
     full_context = user_query
     if additional_details:
         full_context += f"\n\nAdditional details: {additional_details}"
     
-    prompt = f"""You are a support ticket triage assistant.
-
-User ticket: {full_context}
-
-{kb_results}
-
-Task:
-1. Write a 1-2 line summary combining the user's issue with relevant known issues
-2. Classify category: Billing, Login, Performance, Bug, or Question/How-To
-3. Assign severity: Low, Medium, High, or Critical
-4. Determine issue_type: known_issue (if similarity > 0.5) or new_issue
-5. Suggest next_action:
-   - For known issues: "Attach KB article [ID] and respond to user" or "Escalate to [team] per [ID]"
-   - For new issues: "Escalate to [team]" or "Ask customer for logs/screenshots"
-
-Call the classify_ticket tool with these fields."""
+    messages = [
+        SystemMessage(content=TRIAGE_SYSTEM_PROMPT),
+        HumanMessage(content=get_ticket_message(user_query, kb_results, additional_details))
+    ]
     
     try:
-        llm = ChatOpenAI(
-            model=settings.OPENAI_MODEL,
-            api_key=settings.OPENAI_API_KEY,
-            temperature=settings.OPENAI_TEMPERATURE,
-            timeout=settings.OPENAI_TIMEOUT,
-            max_retries=0  # We handle retries ourselves
-        )
+        response = await call_llm_with_retry(get_models().classify, messages)
         
-        llm_with_tools = llm.bind_tools([classify_ticket], tool_choice="classify_ticket")
+        # Structured outputs guarantee the content matches TriageClassification
+        classification = orjson.loads(response.content)
         
-        response = call_llm_with_retry(llm_with_tools, [SystemMessage(content=prompt)])
+        needs_more_info = classification.pop("needs_more_info", False)
+        question = classification.pop("clarifying_question", "")
         
-        if response.tool_calls:
-            tool_call = response.tool_calls[0]
-            classification = tool_call["args"]
-        else:
-            # Fallback classification if tool call fails
-            classification = {
-                "summary": full_context[:100],
-                "category": "Bug",
-                "severity": "Medium",
-                "issue_type": "new_issue",
-                "next_action": "Manual review required - classification incomplete"
+        # Only ask once; after the user has answered we classify with what we have
+        if needs_more_info and question and not additional_details and settings.ENABLE_INTERRUPTS:
+            return {
+                "needs_more_info": True,
+                "interrupt_question": question,
+                "messages": [AIMessage(content=f"🤔 I need more information to properly classify this ticket.\n\nQuestion: {question}")]
             }
-            logger.warning("No tool calls in response, using fallback classification")
         
         return {
             "classification": classification,
+            "needs_more_info": False,
             "messages": [response]
         }
     
@@ -189,71 +167,134 @@ Call the classify_ticket tool with these fields."""
         logger.error(f"LLM error in classify_node: {e}")
         error_info = handle_llm_error(e)
         
-        # Return fallback classification
-        fallback_classification = {
-            "summary": full_context[:100] + "...",
-            "category": "Bug",
-            "severity": "Medium",
-            "issue_type": "new_issue",
-            "next_action": f"Manual review required - {error_info['message']}"
-        }
-        
         return {
-            "classification": fallback_classification,
+            "classification": fallback_classification(
+                full_context[:100] + "...",
+                f"Manual review required - {error_info['message']}"
+            ),
             "messages": [AIMessage(content=f"⚠️ Classification completed with fallback due to error: {error_info['message']}")]
         }
     
     except Exception as e:
         logger.error(f"Unexpected error in classify_node: {e}", exc_info=True)
         
-        # Return minimal fallback classification
-        fallback_classification = {
-            "summary": "Error during classification",
-            "category": "Bug",
-            "severity": "Medium",
-            "issue_type": "new_issue",
-            "next_action": "Manual review required - unexpected error"
-        }
-        
         return {
-            "classification": fallback_classification,
+            "classification": fallback_classification(
+                "Error during classification",
+                "Manual review required - unexpected error"
+            ),
             "messages": [AIMessage(content="⚠️ An error occurred during classification. Please review manually.")]
         }
 
 
-def should_interrupt(state: AgentState) -> Literal["interrupt", "classify"]:
-    """Decide whether to interrupt for more info or proceed to classification."""
+async def classify_batch(tickets: List[dict]) -> Dict[int, dict]:
+    """Classify several tickets with a single LLM call.
+    
+    Args:
+        tickets: List of dicts with "description" and "kb_results" keys
+        
+    Returns:
+        dict mapping the 1-based ticket number to its classification. Tickets the
+        model skipped or numbered incorrectly are missing from the result.
+        
+    Raises:
+        LLMError: If the LLM call fails after retries
+    """
+    ticket_blocks = "\n\n".join(
+        f"[{i}] User ticket: {ticket['description']}\n{ticket['kb_results']}"
+        for i, ticket in enumerate(tickets, start=1)
+    )
+    
+    response = await call_llm_with_retry(get_models().classify_batch, [
+        SystemMessage(content=BATCH_TRIAGE_SYSTEM_PROMPT),
+        HumanMessage(content=ticket_blocks)
+    ])
+    
+    try:
+        items = orjson.loads(response.content)["classifications"]
+    except (TypeError, orjson.JSONDecodeError, KeyError) as e:
+        # Only happens if the model refused to answer
+        logger.warning(f"Unparseable batch response: {e}")
+        return {}
+    
+    classifications = {}
+    for item in items:
+        try:
+            item = dict(item)
+            number = int(item.pop("ticket"))
+        except (TypeError, KeyError, ValueError):
+            logger.warning(f"Skipping malformed batch classification: {item}")
+            continue
+        
+        if 1 <= number <= len(tickets):
+            classifications[number] = item
+    
+    return classifications
+
+
+def should_interrupt(state: AgentState) -> Literal["interrupt", "complete"]:
+    """Decide whether to interrupt for more info or finish the triage."""
     if state.get("needs_more_info", False) and not state.get("additional_details"):
         return "interrupt"
-    return "classify"
+    return "complete"
+
+
+class BoundedMemorySaver(MemorySaver):
+    """In-memory checkpointer that only keeps the most recently used threads.
+    
+    MemorySaver keeps every thread forever; this drops the least recently
+    written thread once max_threads is exceeded, so memory stays bounded.
+    """
+    
+    def __init__(self, max_threads: int = 1000):
+        super().__init__()
+        self.max_threads = max_threads
+        self._threads = OrderedDict()
+        self._lock = threading.Lock()  # aput runs put in executor threads
+    
+    def put(self, config, checkpoint, metadata, new_versions):
+        with self._lock:
+            result = super().put(config, checkpoint, metadata, new_versions)
+            
+            thread_id = config["configurable"]["thread_id"]
+            self._threads[thread_id] = None
+            self._threads.move_to_end(thread_id)
+            
+            while len(self._threads) > self.max_threads:
+                oldest, _ = self._threads.popitem(last=False)
+                self.storage.pop(oldest, None)
+                for key in [key for key in self.writes if key[0] == oldest]:
+                    del self.writes[key]
+            
+            return result
 
 
 def build_graph():
     workflow = StateGraph(AgentState)
     
     workflow.add_node("search_kb", search_kb_node)
-    workflow.add_node("analyze", analyze_node)
     workflow.add_node("classify", classify_node)
     
     workflow.set_entry_point("search_kb")
-    workflow.add_edge("search_kb", "analyze")
+    workflow.add_edge("search_kb", "classify")
     
-    # Conditional edge: interrupt if more info needed, otherwise classify
+    # Conditional edge: interrupt if more info needed, otherwise we're done.
+    # Resuming re-enters the graph after search_kb (see TriageAgent.resume_with_details)
     workflow.add_conditional_edges(
-        "analyze",
+        "classify",
         should_interrupt,
         {
             "interrupt": END,  # Stop here and wait for user input
-            "classify": "classify"
+            "complete": END
         }
     )
     
-    workflow.add_edge("classify", END)
-    
-    # Add checkpointer for state persistence
+    # Checkpoints are only needed to resume interrupted threads
     # Only interrupt at END when needs_more_info is True (handled by conditional edge)
-    memory = MemorySaver()
-    return workflow.compile(checkpointer=memory)
+    checkpointer = None
+    if settings.ENABLE_INTERRUPTS:
+        checkpointer = BoundedMemorySaver(max_threads=settings.MAX_CHECKPOINT_THREADS)
+    return workflow.compile(checkpointer=checkpointer)
 
 
 graph = build_graph()
@@ -1,6 +1,12 @@
-from pydantic import BaseModel, Field
-from typing import List, Optional
+import re
+from pydantic import BaseModel, BeforeValidator, Field, StringConstraints
+from typing import Annotated, Any, List, Optional
 from enum import Enum
+from app.config import get_settings
+
+
+# Read once: field constraints are fixed when the models are defined
+MAX_DESCRIPTION_LENGTH = get_settings().MAX_DESCRIPTION_LENGTH
 
 
 class CategoryEnum(str, Enum):
@@ -23,6 +29,23 @@ class IssueTypeEnum(str, Enum):
     NEW_ISSUE = "new_issue"
 
 
+# Plain-string values of the enums above, for cheap membership checks
+CATEGORIES = frozenset(category.value for category in CategoryEnum)
+SEVERITIES = frozenset(severity.value for severity in SeverityEnum)
+ISSUE_TYPES = frozenset(issue_type.value for issue_type in IssueTypeEnum)
+
+
+# C0 control characters other than tab and line breaks, plus DEL. A single
+# character class, so one linear pass with no backtracking whatever the input
+_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+
+
+def _strip_control_chars(value: Any) -> Any:
+    if isinstance(value, str):
+        return _CONTROL_CHARS.sub("", value)
+    return value
+
+
 class KnownIssue(BaseModel):
     id: str
     title: str
@@ -30,7 +53,39 @@ class KnownIssue(BaseModel):
 
 
 class TriageRequest(BaseModel):
-    description: str = Field(..., description="Support ticket description")
+    # Checked while the body is parsed, before the endpoint runs. Control
+    # characters are dropped first, so descriptions of only those or whitespace
+    # strip to "" and fail min_length
+    description: Annotated[
+        str,
+        StringConstraints(strip_whitespace=True, min_length=1, max_length=MAX_DESCRIPTION_LENGTH),
+        BeforeValidator(_strip_control_chars)
+    ] = Field(..., description="Support ticket description")
+
+
+class TriageClassification(BaseModel):
+    """Classification of a single support ticket."""
+    summary: str = Field(..., description="1-2 line overall summary of the ticket")
+    category: CategoryEnum
+    severity: SeverityEnum
+    issue_type: IssueTypeEnum
+    next_action: str = Field(..., description="Suggested next step for handling this ticket")
+    needs_more_info: bool = Field(..., description="True only if the ticket is too vague to triage")
+    clarifying_question: str = Field(..., description="Question to ask the user when needs_more_info is true, otherwise empty")
+
+
+class TicketClassification(BaseModel):
+    ticket: int = Field(..., description="Ticket number shown in brackets, e.g. 1 for [1]")
+    summary: str = Field(..., description="1-2 line overall summary of the ticket")
+    category: CategoryEnum
+    severity: SeverityEnum
+    issue_type: IssueTypeEnum
+    next_action: str = Field(..., description="Suggested next step for handling this ticket")
+
+
+class BatchClassification(BaseModel):
+    """Classifications of a batch of support tickets, one entry per ticket."""
+    classifications: List[TicketClassification]
 
 
 class TriageResponse(BaseModel):
@@ -1,15 +1,87 @@
-import json
+import asyncio
 import logging
+import os
+import time
 import uuid
-from langchain_core.messages import HumanMessage
-from agent.graph import graph
+import orjson
+from contextlib import aclosing
+from functools import lru_cache
+from typing import List
+from pydantic import ValidationError
+from langchain_core.messages import HumanMessage, AIMessageChunk
+from agent.graph import graph, classify_node, classify_batch, fallback_classification
+from agent.models import TriageResponse, KnownIssue, CATEGORIES, SEVERITIES, ISSUE_TYPES
+from agent.tools import kb, format_kb_results
+from agent.cache import SemanticCache
+from agent.fast_router import FastRouter
+from agent.utils import LLMError, handle_llm_error, StreamingFieldParser
+from app.config import get_settings
 
 logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+# Events buffered between the graph and the HTTP response
+STREAM_QUEUE_SIZE = 32
+_STREAM_END = object()
+
+
+# NumPy arrays and scalars (e.g. KB scores) are encoded natively, without .tolist()/float()
+_NDJSON_OPTIONS = orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _ndjson(event: dict) -> bytes:
+    """Serialize a stream event as one NDJSON line."""
+    return orjson.dumps(event, option=_NDJSON_OPTIONS)
+
+
+def _kb_search_event(kb_results: str) -> bytes:
+    return _ndjson({
+        "type": "kb_search_complete",
+        "data": kb_results
+    })
+
+
+_TRIAGE_COMPLETE = _ndjson({
+    "type": "status", 
+    "message": "Triage complete"
+})
+
+
+# The graph only has a couple of nodes, so their lifecycle events are encoded once
+@lru_cache(maxsize=64)
+def _node_start_event(node_name: str) -> bytes:
+    return _ndjson({
+        "type": "node_start",
+        "node": node_name,
+        "message": f"Executing node: {node_name}"
+    })
+
+
+@lru_cache(maxsize=64)
+def _node_complete_event(node_name: str) -> bytes:
+    return _ndjson({
+        "type": "node_complete",
+        "node": node_name
+    })
 
 
 class TriageAgent:
     def __init__(self):
         self.active_threads = {}  # Store thread_id -> state mapping
+        self.cache = SemanticCache(
+            max_size=settings.SEMANTIC_CACHE_SIZE,
+            ttl=settings.SEMANTIC_CACHE_TTL,
+            threshold=settings.SEMANTIC_CACHE_THRESHOLD
+        )
+        self.cache_path = settings.SEMANTIC_CACHE_PATH
+        # Classifies clear-cut tickets by keyword, without an LLM call; off by default
+        self.fast_router = None
+        if settings.FAST_ROUTER_ENABLED:
+            self.fast_router = FastRouter(min_matches=settings.FAST_ROUTER_MIN_MATCHES)
+        # text_key -> future resolved once that ticket's classification is settled
+        self._inflight = {}
+        self.load_cache()
     
     async def triage_stream(self, description: str, thread_id: str = None):
         """Start a new triage or continue an existing one."""
@@ -24,11 +96,11 @@ class TriageAgent:
         config = {"configurable": {"thread_id": thread_id}}
         
         if is_new:
-            yield json.dumps({
+            yield _ndjson({
                 "type": "status", 
                 "message": "🤖 I'm working on it... Please wait a moment while I embed the knowledge base",
                 "thread_id": thread_id
-            }) + "\n"
+            })
             
             initial_state = {
                 "messages": [HumanMessage(content=description)],
@@ -41,87 +113,226 @@ class TriageAgent:
             
             stream_input = initial_state
         else:
-            yield json.dumps({
+            yield _ndjson({
                 "type": "status", 
                 "message": "Resuming triage...",
                 "thread_id": thread_id
-            }) + "\n"
+            })
             
             # When resuming, pass None to continue from checkpoint
             stream_input = None
         
         try:
-            async for event in graph.astream(stream_input, config=config, stream_mode="updates"):
-                for node_name, node_output in event.items():
-                    yield json.dumps({
-                        "type": "node_start",
-                        "node": node_name,
-                        "message": f"Executing node: {node_name}"
-                    }) + "\n"
-                    
-                    if node_name == "search_kb" and "kb_results" in node_output:
-                        yield json.dumps({
-                            "type": "kb_search_complete",
-                            "data": node_output["kb_results"]
-                        }) + "\n"
-                    
-                    if node_name == "analyze" and node_output.get("needs_more_info"):
-                        yield json.dumps({
-                            "type": "interrupt",
-                            "question": node_output.get("interrupt_question", ""),
-                            "thread_id": thread_id,
-                            "message": "Agent needs more information to continue"
-                        }) + "\n"
-                    
-                    if node_name == "classify" and "classification" in node_output:
-                        yield json.dumps({
-                            "type": "classification_complete",
-                            "data": node_output["classification"]
-                        }) + "\n"
-                    
-                    if "messages" in node_output:
-                        for msg in node_output["messages"]:
-                            if hasattr(msg, 'content') and msg.content:
-                                yield json.dumps({
-                                    "type": "message",
-                                    "content": msg.content
-                                }) + "\n"
-                            
-                            if hasattr(msg, 'tool_calls') and msg.tool_calls:
-                                for tool_call in msg.tool_calls:
-                                    yield json.dumps({
-                                        "type": "tool_call",
-                                        "tool": tool_call.get("name", "unknown"),
-                                        "args": tool_call.get("args", {})
-                                    }) + "\n"
-                    
-                    yield json.dumps({
-                        "type": "node_complete",
-                        "node": node_name
-                    }) + "\n"
+            if not is_new:
+                async with aclosing(self._run_graph(stream_input, config, thread_id)) as events:
+                    async for item in events:
+                        yield item
+                return
             
-            # Check if we're interrupted
-            current_state = graph.get_state(config)
+            text_key = self.cache.text_key(description)
+            embedding = None
+            while True:
+                cached = self.cache.get_exact(text_key)
+                if cached is None:
+                    if embedding is None:
+                        # Also warms the KB embedding cache for the search_kb node
+                        embedding = await kb.aembed(description)
+                    cached = self.cache.get(embedding)
+                
+                flight = self._inflight.get(text_key)
+                if cached is not None or flight is None:
+                    break
+                # An identical ticket is being classified; wait for its answer
+                # (not for its client to read the stream), then check the cache again
+                await asyncio.shield(flight)
             
-            # Check if we're actually interrupted (needs_more_info is True and no classification)
-            if (current_state.values.get("needs_more_info") and 
-                not current_state.values.get("classification")):
-                # We're interrupted, waiting for input
-                yield json.dumps({
-                    "type": "status", 
-                    "message": "Waiting for user response...",
-                    "thread_id": thread_id
-                }) + "\n"
-            else:
-                # Completed
-                yield json.dumps({
-                    "type": "status", 
-                    "message": "Triage complete"
-                }) + "\n"
+            if cached is not None:
+                # Repeat or near-duplicate of a recent ticket: reuse its classification
+                _, classification_event, replay = cached
+                if replay is not None and replay[0] == kb.snapshot:
+                    # The whole answer was pre-encoded against this KB; send it in one write
+                    yield replay[1]
+                    return
+                
+                # The KB changed since, so resolve related issues against the current one
+                kb_hits = await kb.asearch(description, 3)
+                yield _kb_search_event(format_kb_results(kb_hits))
+                yield classification_event
+                yield _TRIAGE_COMPLETE
+                return
+            
+            route = self.fast_router.match(description) if self.fast_router else None
+            if route is not None:
+                kb_hits = await kb.asearch(description, 3)
+                yield _kb_search_event(format_kb_results(kb_hits))
+                yield _ndjson({
+                    "type": "classification_complete",
+                    "data": self.fast_router.classify(route, description, kb_hits),
+                    "routed": True
+                })
+                yield _TRIAGE_COMPLETE
+                return
+            
+            # Identical tickets arriving meanwhile wait for this one's answer
+            # instead of each paying for their own LLM call
+            flight = asyncio.get_running_loop().create_future()
+            self._inflight[text_key] = flight
+            # Closed with this stream, so the graph stops as soon as the client goes away
+            async with aclosing(
+                self._run_graph(stream_input, config, thread_id, embedding, text_key, flight)
+            ) as events:
+                async for item in events:
+                    yield item
             
         except Exception as e:
             logger.error(f"Error in triage_stream: {e}", exc_info=True)
-            yield json.dumps({"type": "error", "message": str(e)}) + "\n"
+            yield _ndjson({"type": "error", "message": str(e)})
+    
+    async def _run_graph(
+        self,
+        stream_input,
+        config: dict,
+        thread_id: str,
+        embedding=None,
+        text_key: str = None,
+        flight: asyncio.Future = None
+    ):
+        """Yield the graph's encoded events."""
+        # Run the graph in its own task so it keeps going while earlier
+        # events are still being written to a slow client
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        producer = asyncio.create_task(
+            self._drain(self._graph_events(stream_input, config, thread_id, embedding, text_key, flight), queue)
+        )
+        if flight is not None:
+            # Release waiting duplicates however the graph ends (error, interrupt, cancel)
+            producer.add_done_callback(lambda _: self._land(text_key, flight))
+        try:
+            while (item := await queue.get()) is not _STREAM_END:
+                yield item
+        finally:
+            # Stop the graph if the client went away mid-stream
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+    
+    def _land(self, text_key: str, flight: asyncio.Future):
+        """Mark a ticket's classification as settled, waking requests that wait on it."""
+        if self._inflight.get(text_key) is flight:
+            del self._inflight[text_key]
+        if not flight.done():
+            flight.set_result(None)
+    
+    async def _graph_events(
+        self,
+        stream_input,
+        config: dict,
+        thread_id: str,
+        embedding,
+        text_key: str = None,
+        flight: asyncio.Future = None
+    ):
+        """Run the graph and yield its progress as encoded stream events."""
+        # Picks fields out of the classify LLM output as it streams in
+        field_parser = StreamingFieldParser()
+        # Whether classify stopped to ask the user a question
+        interrupted = False
+        kb_results = None
+        
+        async for mode, event in graph.astream(stream_input, config=config, stream_mode=["messages", "updates"]):
+            if mode == "messages":
+                # Emit each classification field as soon as the model finishes writing it
+                chunk, metadata = event
+                if metadata.get("langgraph_node") != "classify" or not isinstance(chunk, AIMessageChunk):
+                    continue
+                
+                for name, value in field_parser.feed(chunk.content).items():
+                    yield _ndjson({
+                        "type": "field",
+                        "name": name,
+                        "value": value
+                    })
+                
+                # Token chunks can arrive already queued; let other requests run in between
+                await asyncio.sleep(0)
+                continue
+            
+            for node_name, node_output in event.items():
+                yield _node_start_event(node_name)
+                
+                if node_name == "search_kb" and "kb_results" in node_output:
+                    kb_results = node_output["kb_results"]
+                    yield _kb_search_event(kb_results)
+                
+                if node_name == "classify" and node_output.get("needs_more_info"):
+                    interrupted = True
+                    yield _ndjson({
+                        "type": "interrupt",
+                        "question": node_output.get("interrupt_question", ""),
+                        "thread_id": thread_id,
+                        "message": "Agent needs more information to continue"
+                    })
+                
+                if node_name == "classify" and node_output.get("classification"):
+                    interrupted = False
+                    # Only cache real LLM classifications (which carry response
+                    # metadata), not error fallbacks. Done before the event is
+                    # queued, so waiting duplicates don't depend on this client
+                    if embedding is not None and any(
+                        getattr(msg, "response_metadata", None) for msg in node_output.get("messages", [])
+                    ):
+                        self._cache_classification(embedding, node_output["classification"], kb_results, text_key)
+                    if flight is not None:
+                        self._land(text_key, flight)
+                    
+                    yield _ndjson({
+                        "type": "classification_complete",
+                        "data": node_output["classification"]
+                    })
+                
+                for msg in node_output.get("messages", ()):
+                    content = getattr(msg, "content", None)
+                    tool_calls = getattr(msg, "tool_calls", None)
+                    
+                    if content:
+                        yield _ndjson({
+                            "type": "message",
+                            "content": content
+                        })
+                    
+                    if tool_calls:
+                        for tool_call in tool_calls:
+                            yield _ndjson({
+                                "type": "tool_call",
+                                "tool": tool_call.get("name", "unknown"),
+                                "args": tool_call.get("args", {})
+                            })
+                
+                yield _node_complete_event(node_name)
+        
+        if interrupted:
+            # We're interrupted, waiting for input
+            yield _ndjson({
+                "type": "status", 
+                "message": "Waiting for user response...",
+                "thread_id": thread_id
+            })
+        else:
+            # Completed
+            yield _TRIAGE_COMPLETE
+    
+    @staticmethod
+    async def _drain(events, queue: asyncio.Queue):
+        """Move events into the queue, ending with _STREAM_END unless cancelled."""
+        try:
+            async for event in events:
+                await queue.put(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in triage_stream: {e}", exc_info=True)
+            await queue.put(_ndjson({"type": "error", "message": str(e)}))
+        
+        await queue.put(_STREAM_END)
     
     async def resume_with_details(self, thread_id: str, additional_details: str):
         """Resume an interrupted workflow with additional user details."""
@@ -129,20 +340,25 @@ class TriageAgent:
         config = {"configurable": {"thread_id": thread_id}}
         
         try:
+            if not graph.checkpointer:
+                raise ValueError("Interrupts are disabled, there is no workflow to resume")
+            
             # Get current state
             current_state = graph.get_state(config)
             
             if not current_state:
                 raise ValueError(f"No workflow found for thread_id: {thread_id}")
             
-            # Update state with additional details
+            # Update state with additional details. Writing as search_kb makes
+            # the graph re-run classify with the new context on resume.
             graph.update_state(
                 config,
                 {
                     "additional_details": additional_details,
                     "needs_more_info": False,
                     "messages": [HumanMessage(content=f"Additional details: {additional_details}")]
-                }
+                },
+                as_node="search_kb"
             )
             
             # Continue streaming from where we left off
@@ -151,4 +367,193 @@ class TriageAgent:
                 
         except Exception as e:
             logger.error(f"Error in resume_with_details: {e}", exc_info=True)
-            yield json.dumps({"type": "error", "message": str(e)}) + "\n"
\ No newline at end of file
+            yield _ndjson({"type": "error", "message": str(e)})
+    
+    async def triage_batch(self, descriptions: List[str], batch_size: int = 6) -> List[TriageResponse]:
+        """Triage many tickets at once, classifying up to batch_size tickets per LLM call.
+        
+        Intended for bulk work (backlog imports, eval runs) where nobody is around
+        to answer clarifying questions, so tickets are never interrupted.
+        """
+        responses = []
+        
+        for start in range(0, len(descriptions), batch_size):
+            chunk = descriptions[start:start + batch_size]
+            
+            # KB lookups are independent I/O, so run them concurrently
+            tickets = await asyncio.gather(*(self._prepare_ticket(description) for description in chunk))
+            
+            pending = [ticket for ticket in tickets if ticket["classification"] is None]
+            if pending:
+                try:
+                    classifications = await classify_batch(pending)
+                    for i, ticket in enumerate(pending, start=1):
+                        if i in classifications:
+                            ticket["classification"] = classifications[i]
+                            ticket["fresh"] = True
+                except LLMError as e:
+                    logger.error(f"LLM error in triage_batch: {e}")
+                    error_info = handle_llm_error(e)
+                    for ticket in pending:
+                        ticket["classification"] = fallback_classification(
+                            ticket["description"][:100] + "...",
+                            f"Manual review required - {error_info['message']}"
+                        )
+            
+            for ticket in tickets:
+                response = None
+                if ticket["classification"]:
+                    response = self._build_response(ticket["classification"], ticket["kb_hits"])
+                
+                if response is None:
+                    # Fall back to classifying this ticket on its own
+                    response = await self._triage_single(ticket)
+                elif ticket.get("fresh"):
+                    self._cache_classification(
+                        ticket["embedding"], ticket["classification"], ticket["kb_results"], ticket["text_key"]
+                    )
+                
+                responses.append(response)
+        
+        return responses
+    
+    async def _prepare_ticket(self, description: str) -> dict:
+        """Embed a ticket, check the cache and search the KB for it."""
+        text_key = self.cache.text_key(description)
+        embedding = await kb.aembed(description)
+        kb_hits = await kb.asearch(description, 3)
+        cached = self.cache.get_exact(text_key) or self.cache.get(embedding)
+        return {
+            "description": description,
+            "text_key": text_key,
+            "embedding": embedding,
+            "classification": cached[0] if cached else None,
+            "kb_hits": kb_hits,
+            "kb_results": format_kb_results(kb_hits)
+        }
+    
+    def _cache_classification(
+        self,
+        embedding: List[float],
+        classification: dict,
+        kb_results: str = None,
+        text_key: str = None,
+        ttl: float = None
+    ):
+        """
+        Cache a classification together with its pre-encoded stream events.
+        
+        With the KB context it was made from, the whole cached answer is encoded
+        up front and tagged with the KB snapshot, so a hit is a single write.
+        """
+        classification_event = _ndjson({
+            "type": "classification_complete",
+            "data": classification,
+            "cached": True
+        })
+        replay = None
+        if kb_results is not None:
+            replay = (kb.snapshot, _kb_search_event(kb_results) + classification_event + _TRIAGE_COMPLETE)
+        self.cache.put(embedding, (classification, classification_event, replay), text_key=text_key, ttl=ttl)
+    
+    def load_cache(self) -> None:
+        """Restore cached classifications saved by save_cache(), skipping expired ones."""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        
+        try:
+            with open(self.cache_path, 'rb') as f:
+                saved = orjson.loads(f.read())
+        except Exception as e:
+            logger.error(f"Error loading triage cache: {e}")
+            return
+        
+        now = time.time()
+        for item in saved:
+            if item["expires_at"] > now:
+                self._cache_classification(
+                    item["embedding"], item["classification"],
+                    text_key=item["text_key"], ttl=item["expires_at"] - now
+                )
+        logger.info(f"Loaded {len(self.cache)} cached classifications from {self.cache_path}")
+    
+    def save_cache(self) -> None:
+        """
+        Write the cached classifications to SEMANTIC_CACHE_PATH, so a restart
+        keeps its warm cache. The file is replaced atomically; a crash mid-write
+        leaves the previous one intact.
+        """
+        if not self.cache_path:
+            return
+        
+        now = time.time()
+        saved = [
+            {
+                "embedding": vector,
+                "classification": value[0],
+                "text_key": text_key,
+                "expires_at": now + ttl
+            }
+            for vector, value, ttl, text_key in self.cache.items()
+        ]
+        
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps(saved, option=orjson.OPT_SERIALIZE_NUMPY))
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.error(f"Error saving triage cache: {e}")
+    
+    async def _triage_single(self, ticket: dict) -> TriageResponse:
+        state = {
+            "messages": [HumanMessage(content=ticket["description"])],
+            "kb_results": ticket["kb_results"],
+            "additional_details": ""
+        }
+        result = await classify_node(state)
+        
+        classification = result.get("classification")
+        if not classification:
+            # The model wanted to ask a question; batch triage can't wait for an answer
+            classification = fallback_classification(
+                ticket["description"][:100],
+                f"Ask customer for more details: {result.get('interrupt_question', '')}"
+            )
+        
+        return self._build_response(classification, ticket["kb_hits"]) or self._build_response(
+            fallback_classification(
+                ticket["description"][:100],
+                "Manual review required - invalid classification"
+            ),
+            ticket["kb_hits"]
+        )
+    
+    @staticmethod
+    def _validate(classification: dict) -> bool:
+        """Cheap check of the enum fields, so bad LLM output skips pydantic's error path."""
+        return (
+            classification.get("category") in CATEGORIES
+            and classification.get("severity") in SEVERITIES
+            and classification.get("issue_type") in ISSUE_TYPES
+        )
+    
+    @classmethod
+    def _build_response(cls, classification: dict, kb_hits: List[dict]):
+        """Build a TriageResponse, or return None if the classification is invalid."""
+        if not cls._validate(classification):
+            logger.warning(f"Invalid classification {classification}")
+            return None
+        
+        try:
+            return TriageResponse(
+                **classification,
+                related_issues=[
+                    KnownIssue(id=hit["id"], title=hit["title"], similarity_score=hit["score"])
+                    for hit in kb_hits
+                ]
+            )
+        except (ValidationError, TypeError) as e:
+            logger.warning(f"Invalid classification {classification}: {e}")
+            return None
@@ -1,42 +1,107 @@
-def get_triage_prompt(kb_context: str) -> str:
-    return f"""You are a support ticket triage assistant. Your job is to analyze support tickets and provide structured classification.
-        {kb_context}
+# The triage instructions never change between requests, so they are sent as a
+# constant system message ahead of the per-ticket message. OpenAI caches prompt
+# prefixes of 1024+ tokens, so keep TRIAGE_SYSTEM_PROMPT above that size
+# (checked by test_classify_prompt_prefix_is_long_enough_to_cache).
+_TRIAGE_RUBRIC = """You are a support ticket triage assistant. Your job is to analyze support tickets and provide structured classification.
 
-        Your task is to:
+Each ticket comes with the results of a knowledge base (KB) search. Every KB result has an ID, a title, a similarity score between 0 and 1, and a recommended action. Use them to decide whether the ticket is a known issue and what should happen next.
 
-        1. Summary: Generate a concise 1-2 line summary that captures the core issue from the user's description and relates it to any similar known issues found in the knowledge base.
+Your task is to:
 
-        2. Category: Classify the ticket into one of these categories:
-        - Billing: Payment issues, invoices, subscriptions
-        - Login: Authentication, password, 2FA problems
-        - Performance: Slow loading, timeouts, database issues
-        - Bug: Application errors, crashes, unexpected behavior
-        - Question/How-To: User asking how to do something
+1. Summary: Generate a concise 1-2 line summary that captures the core issue from the user's description and relates it to any similar known issues found in the knowledge base.
+   - Mention the affected feature, platform and error message if the user gave them
+   - Mention the KB ID when the ticket matches a known issue
+   - Do not copy the ticket verbatim and do not include greetings or signatures
 
-        3. Severity: Assign severity level:
-        - Critical: Service completely down, affects many users
-        - High: Major functionality broken, affects workflow
-        - Medium: Feature not working but workarounds exist
-        - Low: Minor issues, cosmetic problems, general questions
+2. Category: Classify the ticket into exactly one of these categories:
+   - Billing: Payment issues, invoices, subscriptions, refunds, updating payment methods, failed renewals
+   - Login: Authentication, password, 2FA problems, locked accounts, expired reset links, SSO
+   - Performance: Slow loading, timeouts, database issues, high latency during peak hours
+   - Bug: Application errors, crashes, unexpected behavior, broken uploads, missing notifications, wrong search results
+   - Question/How-To: User asking how to do something, e.g. exporting data or integrating with the API
+   If a ticket fits several categories, pick the one the user is most blocked by. A checkout that fails with an error is a Bug, a card that is charged twice is Billing.
 
-        4. Issue Type: Determine if this is:
-        - known_issue: Similar issue exists in KB with similarity score > 0.5
-        - new_issue: No matching issue found or similarity score < 0.5
+3. Severity: Assign severity level:
+   - Critical: Service completely down, data loss, security problems, or payments failing for many users
+   - High: Major functionality broken, affects workflow, no workaround (e.g. cannot log in, cannot check out)
+   - Medium: Feature not working but workarounds exist, or the problem affects a single user
+   - Low: Minor issues, cosmetic problems, general questions and how-to requests
+   Errors that block revenue (checkout, billing) or access (login) are at least High. Questions are Low unless the user is blocked by a deadline.
 
-        5. Next Action: Suggest specific next step:
-        - For known issues with KB articles: "Attach KB article [ID] and respond to user"
-        - For known issues needing escalation: "Escalate to [team] team; link to [ID]"
-        - For new issues: "Escalate to [team] team" or "Ask customer for logs/screenshots"
+4. Issue Type: Determine if this is:
+   - known_issue: Similar issue exists in KB with similarity score > 0.5
+   - new_issue: No matching issue found or similarity score <= 0.5
+   Only use the similarity scores you were given; never invent KB IDs.
 
-        Use the classify_ticket function to provide your structured analysis."""
+5. Next Action: Suggest one specific next step:
+   - For known issues with KB articles: "Attach KB article [ID] and respond to user"
+   - For known issues needing escalation: "Escalate to [team] team; link to [ID]", using the team named in the KB recommended action
+   - For new issues: "Escalate to [team] team" or "Ask customer for logs/screenshots"
+   Teams: payments (checkout and payment errors), billing (invoices, subscriptions), auth (login, 2FA, password resets), mobile (iOS and Android app crashes), backend (database and API errors, timeouts), search (search quality), frontend (web UI bugs), support (how-to questions).
 
+Examples:
+- "Getting error 500 when I try to pay on my phone" with ISSUE-101 at 0.82 -> Bug, High, known_issue, "Escalate to payments team; link to ISSUE-101"
+- "How do I download all my data as a spreadsheet?" with ISSUE-106 at 0.71 -> Question/How-To, Low, known_issue, "Attach KB article ISSUE-106 and respond to user"
+- "Dashboard takes 30 seconds to load every morning" with ISSUE-103 at 0.64 -> Performance, Medium, known_issue, "Escalate to backend team; link to ISSUE-103"
+- "The dark mode toggle resets after every reload" with no KB match above 0.5 -> Bug, Low, new_issue, "Escalate to frontend team"
+- "I was charged twice for my March subscription" with ISSUE-113 at 0.41 -> Billing, High, new_issue, "Escalate to billing team"
 
-def get_kb_context(kb_results: list) -> str:
-    if not kb_results:
+Working with KB results:
+- If several KB results score above 0.5, base the issue type and next action on the highest-scoring one
+- A high score with an unrelated title (e.g. a login ticket matching a billing entry) is not a match; treat the ticket as a new issue
+- "No matching known issues found" means the ticket is a new issue
+- Keep the category of the ticket itself even if the matching KB entry uses a different one
+"""
+
+TRIAGE_SYSTEM_PROMPT = _TRIAGE_RUBRIC + """
+6. Decide whether you need more information from the user. Only set needs_more_info if:
+   - The ticket is extremely vague (e.g., "something is broken", "not working")
+   - You cannot determine which category it belongs to
+   - The description is so unclear that you're unsure if it matches any KB entry or not
+   If so, put one specific question for the user in clarifying_question.
+
+Examples:
+- "App is slow" -> proceed (can classify as Performance, even without exact KB match)
+- "Getting error 500 on checkout" -> proceed (specific enough, clear category)
+- "Login not working" -> proceed (clear category, can match or escalate)
+- "Mobile error" -> proceed (vague but has context - mobile + error, can classify)
+- "Something is broken" -> needs_more_info, clarifying_question: What exactly isn't working? Can you describe which feature or page you're having trouble with?
+- "Help" -> needs_more_info, clarifying_question: What do you need help with? Please describe your question or issue.
+
+Only ask for more information if the ticket provides NO actionable information. If the user has already answered a question (shown as additional details), classify with what you have.
+
+Respond with these fields."""
+
+BATCH_TRIAGE_SYSTEM_PROMPT = _TRIAGE_RUBRIC + """
+You will be given several numbered tickets. Triage each ticket independently; each one is followed by its own knowledge base search results.
+
+Respond with one entry per ticket in classifications, using the ticket number in brackets as "ticket"."""
+
+
+def get_ticket_message(user_query: str, kb_results: str, additional_details: str = "") -> str:
+    """Per-request part of the classify prompt, sent after TRIAGE_SYSTEM_PROMPT."""
+    parts = [f"User ticket: {user_query}"]
+    if additional_details:
+        parts.append(f"Additional details: {additional_details}")
+    parts.append(kb_results)
+    return "\n\n".join(parts)
+
+
+def format_kb_block(hits) -> str:
+    """
+    Render KB search hits as the context block given to the LLM.
+    
+    Args:
+        hits: (id, title, score, recommended_action) tuples, in rank order
+    """
+    # Callers pass generators, which are truthy even when empty
+    hits = tuple(hits)
+    if not hits:
         return "No matching known issues found in the knowledge base."
     
-    context = "Related known issues found:\n"
-    for item in kb_results:
-        context += f"- ID: {item['id']} | {item['title']} | Similarity: {item['score']:.2f}\n"
+    lines = ["Found related known issues:"]
+    for issue_id, title, score, recommended_action in hits:
+        lines.append(f"- ID: {issue_id} | {title} | Similarity: {score:.2f}")
+        lines.append(f"  Recommended action: {recommended_action}")
     
-    return context.strip()
+    return "\n".join(lines) + "\n"
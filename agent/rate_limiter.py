@@ -0,0 +1,178 @@
+# agent/rate_limiter.py
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Durations in OpenAI's x-ratelimit-reset-* headers, e.g. "20ms", "1s", "6m0s"
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNIT_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _UNIT_SECONDS[unit] for amount, unit in parts)
+
+
+class RateLimiter:
+    """
+    Client-side throttle for OpenAI requests, so bursts slow down before the
+    provider starts answering 429 instead of after.
+
+    Two signals decide how long a request waits before it is sent:
+    - a sliding one-minute window of our own request timestamps, capped at
+      rpm_limit (0 disables it)
+    - the x-ratelimit-* headers of earlier responses: once the remaining
+      requests or tokens drop to threshold of the limit, requests wait for
+      the reported reset, and a Retry-After pauses everyone
+
+    Clients attach limiters through EndpointRateLimiters.
+
+    Args:
+        rpm_limit: Requests allowed per minute, 0 for no client-side window
+        tpm_limit: Token limit to assume until the provider reports one, 0 for none
+        threshold: Fraction of the limit left at which requests start waiting
+    """
+
+    window = 60.0  # seconds
+
+    def __init__(self, rpm_limit: int = 0, tpm_limit: int = 0, threshold: float = 0.1):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.threshold = threshold
+        self.remaining_requests: Optional[int] = None
+        self.limit_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.limit_tokens: Optional[int] = tpm_limit or None
+        self.reset_at = 0.0  # monotonic time the provider's window resets
+        self._sent: deque = deque()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Claim a slot for one request and return the seconds to wait before sending it."""
+        with self._lock:
+            now = time.monotonic()
+            send_at = now
+
+            if self._near_limit(self.remaining_requests, self.limit_requests) or \
+                    self._near_limit(self.remaining_tokens, self.limit_tokens):
+                send_at = max(send_at, self.reset_at)
+
+            if self.rpm_limit:
+                while self._sent and self._sent[0] <= now - self.window:
+                    self._sent.popleft()
+                if len(self._sent) >= self.rpm_limit:
+                    send_at = max(send_at, self._sent.popleft() + self.window)
+                self._sent.append(send_at)
+
+            if self.remaining_requests:
+                # Count this request against the budget until the next response says otherwise
+                self.remaining_requests -= 1
+
+            return send_at - now
+
+    def update(self, headers: httpx.Headers) -> None:
+        """Record the provider's view of our limits from a response."""
+        with self._lock:
+            now = time.monotonic()
+            self.remaining_requests = self._int(headers.get("x-ratelimit-remaining-requests"), self.remaining_requests)
+            self.limit_requests = self._int(headers.get("x-ratelimit-limit-requests"), self.limit_requests)
+            self.remaining_tokens = self._int(headers.get("x-ratelimit-remaining-tokens"), self.remaining_tokens)
+            self.limit_tokens = self._int(headers.get("x-ratelimit-limit-tokens"), self.limit_tokens)
+
+            resets = [
+                _parse_duration(headers[name])
+                for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+                if name in headers
+            ]
+            resets = [reset for reset in resets if reset is not None]
+            if resets:
+                self.reset_at = now + max(resets)
+
+            retry_after = headers.get("retry-after")
+            if retry_after is not None:
+                try:
+                    self.reset_at = max(self.reset_at, now + float(retry_after))
+                    self.remaining_requests = 0
+                except ValueError:
+                    pass
+
+    def _near_limit(self, remaining: Optional[int], limit: Optional[int]) -> bool:
+        if remaining is None:
+            return False
+        if limit:
+            return remaining <= limit * self.threshold
+        return remaining <= 0
+
+    @staticmethod
+    def _int(value: Optional[str], default: Optional[int]) -> Optional[int]:
+        try:
+            return int(value) if value is not None else default
+        except ValueError:
+            return default
+
+
+class EndpointRateLimiters:
+    """
+    One RateLimiter per OpenAI endpoint (embeddings, chat/completions, ...),
+    so a single pooled client can serve all of them: OpenAI limits each model
+    separately, and mixing their headers in one limiter would make it flap.
+
+    Attach to an httpx client with sync_hooks() or async_hooks().
+
+    Args:
+        Passed on to each RateLimiter
+    """
+
+    def __init__(self, rpm_limit: int = 0, tpm_limit: int = 0, threshold: float = 0.1):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.threshold = threshold
+        self._limiters: Dict[str, RateLimiter] = {}
+        self._lock = threading.Lock()
+
+    def get(self, endpoint: str) -> RateLimiter:
+        with self._lock:
+            if endpoint not in self._limiters:
+                self._limiters[endpoint] = RateLimiter(self.rpm_limit, self.tpm_limit, self.threshold)
+            return self._limiters[endpoint]
+
+    def for_request(self, request: httpx.Request) -> RateLimiter:
+        # "/v1/chat/completions" -> "chat/completions"
+        return self.get(request.url.path.rsplit("/v1/", 1)[-1])
+
+    def sync_hooks(self) -> dict:
+        """Event hooks for httpx.Client."""
+        def before(request: httpx.Request):
+            delay = self.for_request(request).reserve()
+            if delay > 0:
+                logger.debug(f"Throttling {request.url.path} for {delay:.2f}s")
+                time.sleep(delay)
+
+        def after(response: httpx.Response):
+            self.for_request(response.request).update(response.headers)
+
+        return {"request": [before], "response": [after]}
+
+    def async_hooks(self) -> dict:
+        """Event hooks for httpx.AsyncClient."""
+        async def before(request: httpx.Request):
+            delay = self.for_request(request).reserve()
+            if delay > 0:
+                logger.debug(f"Throttling {request.url.path} for {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+        async def after(response: httpx.Response):
+            self.for_request(response.request).update(response.headers)
+
+        return {"request": [before], "response": [after]}
@@ -1,53 +1,47 @@
 from langchain_core.tools import tool
+from functools import lru_cache
 from typing import List, Dict
-import json
-from kb.search import KnowledgeBase
+from kb.search import get_knowledge_base
+from agent.prompts import format_kb_block
 
 
-kb = KnowledgeBase()
+kb = get_knowledge_base()
 
 
-@tool
-def search_knowledge_base(query: str) -> str:
-    """Search the knowledge base for similar tickets and known issues."""
-    
-    results = kb.search(query, top_k=3)
-    
-    if not results:
-        return "No matching known issues found in the knowledge base."
-    
-    output = "Found related known issues:\n"
-    for item in results:
-        output += f"- ID: {item['id']} | {item['title']} | Similarity: {item['score']:.2f}\n"
-        output += f"  Recommended action: {item['recommended_action']}\n"
-    
-    return output
+def format_kb_results(results: List[Dict]) -> str:
+    """Render KB search results as the context block given to the LLM."""
+    # Scores are shown with 2 decimals, so rounding keeps the memo key as coarse as the output
+    key = tuple((item['id'], round(item['score'], 2)) for item in results)
+    try:
+        return _format_kb_hits(key, kb.snapshot)
+    except KeyError:
+        # Not an entry of the current KB snapshot; render from the results themselves
+        return format_kb_block(
+            (item['id'], item['title'], item['score'], item['recommended_action'])
+            for item in results
+        )
 
 
-@tool
-def classify_ticket(
-    summary: str,
-    category: str,
-    severity: str,
-    issue_type: str,
-    next_action: str
-) -> str:
-    """Classify and triage a support ticket with all required fields.
+@lru_cache(maxsize=4096)
+def _format_kb_hits(hits: tuple, snapshot: int) -> str:
+    """
+    Memoized rendering of (id, rounded score) hits against one KB snapshot.
     
-    Args:
-        summary: 1-2 line overall summary of the ticket
-        category: One of Billing, Login, Performance, Bug, Question/How-To
-        severity: One of Low, Medium, High, Critical
-        issue_type: Either known_issue or new_issue
-        next_action: Suggested next step for handling this ticket
+    Support traffic repeats: the same few known issues come back for most
+    tickets, so the block is usually already built. Titles and actions are
+    looked up from the KB, so a reload (new snapshot) never serves stale text.
     """
+    entries = kb.entries_by_id
+    return format_kb_block(
+        (issue_id, entries[issue_id]['title'], score, entries[issue_id].get('recommended_action', ''))
+        for issue_id, score in hits
+    )
+
+
+@tool
+def search_knowledge_base(query: str) -> str:
+    """Search the knowledge base for similar tickets and known issues."""
     
-    result = {
-        "summary": summary,
-        "category": category,
-        "severity": severity,
-        "issue_type": issue_type,
-        "next_action": next_action
-    }
+    results = kb.search(query, top_k=3)
     
-    return json.dumps(result)
+    return format_kb_results(results)
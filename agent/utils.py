@@ -1,23 +1,83 @@
 # agent/utils.py
 
+import asyncio
+import json
+import random
+import re
 import time
 import logging
-from typing import Callable, TypeVar, Any
+from typing import Callable, Dict, TypeVar, Any, Optional
 from functools import wraps
 from openai import APIError, APITimeoutError, RateLimitError, APIConnectionError
 from app.config import get_settings
 
 logger = logging.getLogger(__name__)
-settings = get_settings()
 
 T = TypeVar('T')
 
-
 class LLMError(Exception):
     """Custom exception for LLM-related errors."""
     pass
 
 
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds the provider asked us to wait (Retry-After headers), if it said."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # HTTP-date form; fall back to our own backoff
+        pass
+    return None
+
+
+def _retry_delay(delay: float, error: Exception) -> float:
+    """
+    How long to sleep before the next attempt.
+    
+    A Retry-After from the provider wins. Otherwise the backoff delay is capped
+    and jittered, taking off up to RETRY_JITTER of it at random so workers that
+    hit the same rate limit don't all retry at the same instant.
+    """
+    settings = get_settings()
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        return min(retry_after, settings.RETRY_MAX_DELAY)
+    
+    return min(delay, settings.RETRY_MAX_DELAY) * (1 - settings.RETRY_JITTER * random.random())
+
+
+def _on_event_loop() -> bool:
+    """Whether the current thread is running an asyncio event loop."""
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def _retry_policy(max_retries, initial_delay, backoff_factor):
+    """
+    Fill in unset decorator arguments from the settings.
+    
+    Resolved per call rather than when the decorator is applied, so module
+    imports don't freeze the retry policy before the environment is final.
+    """
+    settings = get_settings()
+    return (
+        settings.MAX_RETRIES if max_retries is None else max_retries,
+        settings.RETRY_DELAY if initial_delay is None else initial_delay,
+        settings.RETRY_BACKOFF if backoff_factor is None else backoff_factor
+    )
+
+
 def retry_with_backoff(
     max_retries: int = None,
     initial_delay: float = None,
@@ -33,53 +93,55 @@ def retry_with_backoff(
         backoff_factor: Multiplier for delay on each retry (uses config default if None)
         exceptions: Tuple of exceptions to catch and retry
     """
-    if max_retries is None:
-        max_retries = settings.MAX_RETRIES
-    if initial_delay is None:
-        initial_delay = settings.RETRY_DELAY
-    if backoff_factor is None:
-        backoff_factor = settings.RETRY_BACKOFF
-    
     def decorator(func: Callable[..., T]) -> Callable[..., T]:
         @wraps(func)
         def wrapper(*args, **kwargs) -> T:
-            delay = initial_delay
+            retries, delay, factor = _retry_policy(max_retries, initial_delay, backoff_factor)
             last_exception = None
             
-            for attempt in range(max_retries + 1):
+            for attempt in range(retries + 1):
                 try:
                     return func(*args, **kwargs)
                     
                 except exceptions as e:
                     last_exception = e
                     
-                    if attempt == max_retries:
+                    if attempt == retries:
                         logger.error(
-                            f"Function {func.__name__} failed after {max_retries} retries. "
-                            f"Last error: {str(e)}"
+                            "Function %s failed after %d retries. Last error: %s",
+                            func.__name__, retries, e
                         )
                         raise LLMError(
-                            f"LLM call failed after {max_retries} retries: {str(e)}"
+                            f"LLM call failed after {retries} retries: {str(e)}"
                         ) from e
                     
+                    sleep_for = _retry_delay(delay, e)
+                    
                     # Special handling for rate limits
                     if isinstance(e, RateLimitError):
                         logger.warning(
-                            f"Rate limit hit for {func.__name__}, "
-                            f"waiting {delay}s before retry {attempt + 1}/{max_retries}"
+                            "Rate limit hit for %s, waiting %.2fs before retry %d/%d",
+                            func.__name__, sleep_for, attempt + 1, retries
                         )
                     else:
                         logger.warning(
-                            f"Attempt {attempt + 1}/{max_retries} failed for {func.__name__}: {str(e)}. "
-                            f"Retrying in {delay}s..."
+                            "Attempt %d/%d failed for %s: %s. Retrying in %.2fs...",
+                            attempt + 1, retries, func.__name__, e, sleep_for
+                        )
+                    
+                    if _on_event_loop():
+                        logger.warning(
+                            "%s is sleeping %.2fs on the event loop thread, stalling every other "
+                            "request; call it via asyncio.to_thread or use retry_with_backoff_async",
+                            func.__name__, sleep_for
                         )
                     
-                    time.sleep(delay)
-                    delay *= backoff_factor
+                    time.sleep(sleep_for)
+                    delay = min(delay * factor, get_settings().RETRY_MAX_DELAY)
                     
                 except Exception as e:
                     # Don't retry on unexpected exceptions
-                    logger.error(f"Unexpected error in {func.__name__}: {str(e)}")
+                    logger.error("Unexpected error in %s: %s", func.__name__, e)
                     raise
             
             # This should never be reached, but just in case
@@ -90,7 +152,7 @@ def retry_with_backoff(
     return decorator
 
 
-async def retry_with_backoff_async(
+def retry_with_backoff_async(
     max_retries: int = None,
     initial_delay: float = None,
     backoff_factor: float = None,
@@ -99,53 +161,46 @@ async def retry_with_backoff_async(
     """
     Async version of retry_with_backoff decorator.
     """
-    import asyncio
-    
-    if max_retries is None:
-        max_retries = settings.MAX_RETRIES
-    if initial_delay is None:
-        initial_delay = settings.RETRY_DELAY
-    if backoff_factor is None:
-        backoff_factor = settings.RETRY_BACKOFF
-    
     def decorator(func: Callable[..., T]) -> Callable[..., T]:
         @wraps(func)
         async def wrapper(*args, **kwargs) -> T:
-            delay = initial_delay
+            retries, delay, factor = _retry_policy(max_retries, initial_delay, backoff_factor)
             last_exception = None
             
-            for attempt in range(max_retries + 1):
+            for attempt in range(retries + 1):
                 try:
                     return await func(*args, **kwargs)
                     
                 except exceptions as e:
                     last_exception = e
                     
-                    if attempt == max_retries:
+                    if attempt == retries:
                         logger.error(
-                            f"Async function {func.__name__} failed after {max_retries} retries. "
-                            f"Last error: {str(e)}"
+                            "Async function %s failed after %d retries. Last error: %s",
+                            func.__name__, retries, e
                         )
                         raise LLMError(
-                            f"LLM call failed after {max_retries} retries: {str(e)}"
+                            f"LLM call failed after {retries} retries: {str(e)}"
                         ) from e
                     
+                    sleep_for = _retry_delay(delay, e)
+                    
                     if isinstance(e, RateLimitError):
                         logger.warning(
-                            f"Rate limit hit for {func.__name__}, "
-                            f"waiting {delay}s before retry {attempt + 1}/{max_retries}"
+                            "Rate limit hit for %s, waiting %.2fs before retry %d/%d",
+                            func.__name__, sleep_for, attempt + 1, retries
                         )
                     else:
                         logger.warning(
-                            f"Attempt {attempt + 1}/{max_retries} failed for {func.__name__}: {str(e)}. "
-                            f"Retrying in {delay}s..."
+                            "Attempt %d/%d failed for %s: %s. Retrying in %.2fs...",
+                            attempt + 1, retries, func.__name__, e, sleep_for
                         )
                     
-                    await asyncio.sleep(delay)
-                    delay *= backoff_factor
+                    await asyncio.sleep(sleep_for)
+                    delay = min(delay * factor, get_settings().RETRY_MAX_DELAY)
                     
                 except Exception as e:
-                    logger.error(f"Unexpected error in {func.__name__}: {str(e)}")
+                    logger.error("Unexpected error in %s: %s", func.__name__, e)
                     raise
             
             if last_exception:
@@ -155,6 +210,53 @@ async def retry_with_backoff_async(
     return decorator
 
 
+def _rate_limit_message(error: Exception) -> dict:
+    return {
+        "error": "rate_limit",
+        "message": "API rate limit exceeded. Please try again in a moment.",
+        "retry_after": _retry_after(error) or 60
+    }
+
+
+def _timeout_message(error: Exception) -> dict:
+    return {
+        "error": "timeout",
+        "message": "Request timed out. Please try again.",
+    }
+
+
+def _connection_message(error: Exception) -> dict:
+    return {
+        "error": "connection",
+        "message": "Unable to connect to AI service. Please check your internet connection.",
+    }
+
+
+def _api_error_message(error: Exception) -> dict:
+    return {
+        "error": "api_error",
+        "message": f"AI service error: {str(error)}",
+    }
+
+
+def _llm_error_message(error: Exception) -> dict:
+    return {
+        "error": "llm_error",
+        "message": str(error),
+    }
+
+
+# Looked up along the error's MRO, so the most specific class wins
+# (RateLimitError and APITimeoutError are themselves APIErrors)
+_ERROR_HANDLERS: Dict[type, Callable[[Exception], dict]] = {
+    RateLimitError: _rate_limit_message,
+    APITimeoutError: _timeout_message,
+    APIConnectionError: _connection_message,
+    APIError: _api_error_message,
+    LLMError: _llm_error_message,
+}
+
+
 def handle_llm_error(error: Exception) -> dict:
     """
     Convert LLM errors to user-friendly messages.
@@ -165,39 +267,94 @@ def handle_llm_error(error: Exception) -> dict:
     Returns:
         dict with error type and message
     """
-    if isinstance(error, RateLimitError):
-        return {
-            "error": "rate_limit",
-            "message": "API rate limit exceeded. Please try again in a moment.",
-            "retry_after": getattr(error, 'retry_after', 60)
-        }
+    for cls in type(error).__mro__:
+        handler = _ERROR_HANDLERS.get(cls)
+        if handler is not None:
+            return handler(error)
     
-    elif isinstance(error, APITimeoutError):
-        return {
-            "error": "timeout",
-            "message": "Request timed out. Please try again.",
-        }
+    return {
+        "error": "unknown",
+        "message": "An unexpected error occurred. Please try again.",
+    }
+
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+class StreamingFieldParser:
+    """
+    Incrementally extract the top-level fields of a JSON object as it streams in.
     
-    elif isinstance(error, APIConnectionError):
-        return {
-            "error": "connection",
-            "message": "Unable to connect to AI service. Please check your internet connection.",
-        }
+    Used on the streamed structured output of the classify call. Each feed() only
+    parses past the last completed field, so the whole buffer is never re-parsed.
+    A field only counts as complete once the separator after its value has
+    arrived, so half-written strings or numbers are never returned.
+    """
     
-    elif isinstance(error, APIError):
-        return {
-            "error": "api_error",
-            "message": f"AI service error: {str(error)}",
-        }
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = None  # Where the next field starts, once '{' has arrived
+        self._done = False
     
-    elif isinstance(error, LLMError):
-        return {
-            "error": "llm_error",
-            "message": str(error),
-        }
+    def feed(self, chunk: str) -> dict:
+        """
+        Add the next chunk of the JSON text.
+        
+        Returns:
+            dict of the fields completed by this chunk, in order
+        """
+        self._buffer += chunk
+        buffer = self._buffer
+        fields = {}
+        
+        if self._done:
+            return fields
+        
+        if self._pos is None:
+            pos = _WHITESPACE.match(buffer, 0).end()
+            if not buffer.startswith("{", pos):
+                return fields
+            self._pos = pos + 1
+        
+        pos = self._pos
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if not buffer.startswith('"', pos):
+                break
+            
+            try:
+                key, pos = self._decoder.raw_decode(buffer, pos)
+                pos = _WHITESPACE.match(buffer, pos).end()
+                if not buffer.startswith(":", pos):
+                    break
+                pos = _WHITESPACE.match(buffer, pos + 1).end()
+                value, pos = self._decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break
+            
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos >= len(buffer) or buffer[pos] not in ",}":
+                break
+            
+            fields[key] = value
+            self._pos = pos + 1
+            if buffer[pos] == "}":
+                self._done = True
+                break
+            pos += 1
+        
+        return fields
+
+
+def parse_completed_fields(partial_json: str) -> dict:
+    """
+    Extract the top-level fields that are already complete in a partial JSON object.
     
-    else:
-        return {
-            "error": "unknown",
-            "message": "An unexpected error occurred. Please try again.",
-        }
+    Args:
+        partial_json: Prefix of a JSON object, e.g. '{"category": "Billing", "sev'
+        
+    Returns:
+        dict of the completed fields, in order
+    """
+    return StreamingFieldParser().feed(partial_json)
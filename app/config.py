@@ -1,8 +1,8 @@
 # app/config.py
 
 import os
-from typing import Optional
-from pydantic_settings import BaseSettings
+from typing import Literal, Optional
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from functools import lru_cache
 
 
@@ -22,20 +22,60 @@ class Settings(BaseSettings):
     MAX_RETRIES: int = 3
     RETRY_DELAY: float = 1.0  # seconds
     RETRY_BACKOFF: float = 2.0  # exponential backoff multiplier
+    RETRY_MAX_DELAY: float = 30.0  # cap on a single backoff sleep, seconds
+    RETRY_JITTER: float = 1.0  # fraction of each delay randomized (1.0 = full jitter)
+    
+    # Client-side rate limiting, to slow down before OpenAI answers 429
+    OPENAI_RPM_LIMIT: int = 0  # requests per minute per client; 0 = only follow response headers
+    OPENAI_TPM_LIMIT: int = 0  # tokens per minute, until the headers report the real limit
+    RATE_LIMIT_THRESHOLD: float = 0.1  # fraction of the limit left at which requests wait
+    
+    # Adaptive cap on concurrent LLM calls (AIMD)
+    LLM_CONCURRENCY_MIN: int = 1
+    LLM_CONCURRENCY_MAX: int = 32
+    LLM_TARGET_LATENCY: float = 10.0  # seconds; the cap shrinks while calls average slower
     
     # App
     PORT: int = 8000
     MAX_DESCRIPTION_LENGTH: int = 5000
+    SSE_PING_INTERVAL: float = 15.0  # seconds of silence before an SSE stream sends a keep-alive
     LOG_LEVEL: str = "INFO"
     
     # KB
     KB_PATH: str = "kb/knowledge_base.json"
+    KB_EMBEDDINGS_DIR: str = "kb"  # where KB embeddings are saved between runs; empty to disable
+    KB_HOT_RELOAD: bool = False  # re-read the KB when its file changes (one stat() per search)
+    # int8 scans a 4x smaller copy of the embeddings and reranks the best hits
+    # with float32; float32 scans the full-precision matrix only
+    KB_EMBEDDING_DTYPE: Literal["int8", "float32"] = "int8"
+    
+    # Embedding cache for queries and KB texts
+    EMBEDDING_CACHE_SIZE: int = 10000  # embeddings kept in memory
+    EMBEDDING_CACHE_PATH: str = ".cache/embeddings.sqlite"  # on-disk layer; empty to disable
+    EMBEDDING_MICROBATCH_SIZE: int = 128  # most concurrent texts sent in one embeddings request
+    EMBEDDING_MICROBATCH_WAIT: float = 0.005  # seconds a text waits for others to batch with
+    
+    # Semantic cache of triage results
+    SEMANTIC_CACHE_SIZE: int = 1000
+    SEMANTIC_CACHE_TTL: int = 3600  # seconds
+    SEMANTIC_CACHE_THRESHOLD: float = 0.97  # cosine similarity
+    SEMANTIC_CACHE_PATH: str = ".cache/triage_cache.json"  # saved at shutdown; empty to disable
+    
+    # Keyword router answering unambiguous tickets without the LLM
+    FAST_ROUTER_ENABLED: bool = False
+    FAST_ROUTER_MIN_MATCHES: int = 2  # distinct phrases of one category needed to route a ticket
+    
+    # Human-in-the-loop. Without interrupts vague tickets are classified as-is
+    # and no per-thread state is kept between requests
+    ENABLE_INTERRUPTS: bool = True
+    MAX_CHECKPOINT_THREADS: int = 1000  # oldest threads are dropped beyond this
     
     # CORS
     CORS_ORIGINS: list = ["*"]
     
-    class Config:
-        env_file = ".env"
+    # Read once per process (see get_settings) and never changed afterwards;
+    # keys in .env that aren't settings (e.g. the frontend's) are ignored
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore", frozen=True)
 
 
 class DevelopmentSettings(Settings):
@@ -43,6 +83,7 @@ class DevelopmentSettings(Settings):
     DEBUG: bool = True
     LOG_LEVEL: str = "DEBUG"
     MAX_RETRIES: int = 2
+    KB_HOT_RELOAD: bool = True
     
 
 class ProductionSettings(Settings):
@@ -60,9 +101,9 @@ class TestingSettings(Settings):
     MAX_RETRIES: int = 1
 
 
-@lru_cache()
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
-    """Get settings based on environment variable."""
+    """Get settings based on environment variable, built once per process."""
     env = os.getenv("ENVIRONMENT", "dev").lower()
     
     if env == "prod" or env == "production":
@@ -70,4 +111,4 @@ def get_settings() -> Settings:
     elif env == "test" or env == "testing":
         return TestingSettings()
     else:
-        return DevelopmentSettings()
\ No newline at end of file
+        return DevelopmentSettings()
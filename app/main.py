@@ -1,12 +1,21 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.exception_handlers import http_exception_handler, request_validation_exception_handler
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import logging
 
 from app.config import get_settings
+from agent.clients import close_openai_clients
+from app.middleware import StreamingGZipMiddleware
+from app.sse import SSE_MEDIA_TYPE, ndjson_to_sse
 from agent.orchestrator import TriageAgent
 from agent.models import TriageRequest
+from kb.search import get_knowledge_base
 
 settings = get_settings()
 
@@ -17,10 +26,41 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+async def warm_up(app: FastAPI):
+    """Build the KB index in the background; /ready reports when it's done."""
+    try:
+        await get_knowledge_base().warmup()
+    except Exception as e:
+        # Searches build the index on demand, so serve anyway
+        logger.error(f"KB warmup failed: {e}")
+    app.state.ready = True
+    logger.info("Warmup complete")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One agent per process, so all requests share its KB index, caches and HTTP pools
+    app.state.agent = TriageAgent()
+    app.state.ready = False
+    warmup = asyncio.create_task(warm_up(app))
+    yield
+    warmup.cancel()
+    await asyncio.to_thread(app.state.agent.save_cache)
+    await close_openai_clients()
+
+
+# Handlers and dependencies that never block are async def, so Starlette runs
+# them on the event loop instead of handing each call to its threadpool
+async def get_agent(request: Request) -> TriageAgent:
+    return request.app.state.agent
+
+
 app = FastAPI(
     title="Ticket Triage Agent",
     debug=settings.DEBUG,
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS configuration based on environment
@@ -32,11 +72,49 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# NDJSON events repeat the same keys, so they compress well; level 1 keeps per-chunk cost low
+app.add_middleware(StreamingGZipMiddleware, minimum_size=512, compresslevel=1)
+
 logger.info(f"Starting application in {settings.ENVIRONMENT} environment")
 logger.info(f"Debug mode: {settings.DEBUG}")
 logger.info(f"Max retries: {settings.MAX_RETRIES}")
 
-agent = TriageAgent()
+
+# TriageRequest rejects bad descriptions during validation; answer those with the
+# same 400s as before rather than FastAPI's generic 422
+_DESCRIPTION_ERRORS = {
+    "string_too_short": "Description cannot be empty",
+    "string_too_long": "Description too long",
+}
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    for error in exc.errors():
+        if tuple(error["loc"]) == ("body", "description") and error["type"] in _DESCRIPTION_ERRORS:
+            return await http_exception_handler(
+                request, HTTPException(status_code=400, detail=_DESCRIPTION_ERRORS[error["type"]])
+            )
+    return await request_validation_exception_handler(request, exc)
+
+
+# Keep reverse proxies (nginx buffers responses by default) and caches from
+# holding events back, so each one reaches the client as it is produced
+STREAM_HEADERS = {
+    "X-Accel-Buffering": "no",
+    "Cache-Control": "no-cache",
+}
+
+
+def stream_response(events: AsyncIterator[bytes], accept: Optional[str]) -> StreamingResponse:
+    """NDJSON by default; Server-Sent Events for clients that ask for text/event-stream."""
+    if accept and SSE_MEDIA_TYPE in accept:
+        return StreamingResponse(
+            ndjson_to_sse(events, ping_interval=settings.SSE_PING_INTERVAL),
+            media_type=SSE_MEDIA_TYPE,
+            headers=STREAM_HEADERS
+        )
+    return StreamingResponse(events, media_type="application/x-ndjson", headers=STREAM_HEADERS)
 
 
 class ResumeRequest(BaseModel):
@@ -45,7 +123,7 @@ class ResumeRequest(BaseModel):
 
 
 @app.get("/")
-def root():
+async def root():
     return {
         "name": "Ticket Triage Agent",
         "status": "running"
@@ -53,25 +131,28 @@ def root():
 
 
 @app.get("/health")
-def health():
+async def health():
     return {"status": "healthy"}
 
 
+@app.get("/ready")
+async def ready(request: Request):
+    if not request.app.state.ready:
+        raise HTTPException(status_code=503, detail="Warming up")
+    return {"status": "ready"}
+
+
 @app.post("/triage/stream")
-async def triage_ticket_stream(request: TriageRequest):
-    if not request.description.strip():
-        raise HTTPException(status_code=400, detail="Description cannot be empty")
-    
-    if len(request.description) > settings.MAX_DESCRIPTION_LENGTH:
-        raise HTTPException(status_code=400, detail="Description too long")
-    
+async def triage_ticket_stream(
+    request: TriageRequest,
+    agent: TriageAgent = Depends(get_agent),
+    accept: Optional[str] = Header(None)
+):
+    # Empty and oversized descriptions were already rejected by TriageRequest
     try:
         logger.info(f"Processing ticket stream: {request.description[:50]}...")
         
-        return StreamingResponse(
-            agent.triage_stream(request.description),
-            media_type="application/x-ndjson"
-        )
+        return stream_response(agent.triage_stream(request.description), accept)
     
     except Exception as e:
         logger.error(f"Error: {e}")
@@ -79,20 +160,21 @@ async def triage_ticket_stream(request: TriageRequest):
 
 
 @app.post("/triage/resume")
-async def resume_ticket_triage(request: ResumeRequest):
+async def resume_ticket_triage(
+    request: ResumeRequest,
+    agent: TriageAgent = Depends(get_agent),
+    accept: Optional[str] = Header(None)
+):
     if not request.thread_id:
         raise HTTPException(status_code=400, detail="thread_id is required")
     
-    if not request.additional_details.strip():
+    if not request.additional_details or request.additional_details.isspace():
         raise HTTPException(status_code=400, detail="additional_details cannot be empty")
     
     try:
         logger.info(f"Resuming workflow for thread: {request.thread_id}")
         
-        return StreamingResponse(
-            agent.resume_with_details(request.thread_id, request.additional_details),
-            media_type="application/x-ndjson"
-        )
+        return stream_response(agent.resume_with_details(request.thread_id, request.additional_details), accept)
     
     except Exception as e:
         logger.error(f"Error resuming workflow: {e}")
@@ -0,0 +1,94 @@
+# app/middleware.py
+
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.sse import SSE_MEDIA_TYPE
+
+# wbits for zlib.compressobj that write a gzip header and trailer
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class _StreamingGZipResponder:
+    """Compresses one response, sync-flushing every chunk of a streamed body."""
+
+    def __init__(self, app: ASGIApp, minimum_size: int, compresslevel: int) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+        self.send: Send = None
+        self.start_message: Message = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_with_gzip)
+
+    async def send_with_gzip(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            # SSE goes out as-is: many proxies and browsers buffer or break
+            # compressed event streams
+            if "content-encoding" in headers or headers.get("content-type", "").startswith(SSE_MEDIA_TYPE):
+                self.passthrough = True
+                await self.send(message)
+            else:
+                # Held until the first body chunk shows whether compressing pays off
+                self.start_message = message
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            if len(body) < self.minimum_size and not more_body:
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+
+            headers = MutableHeaders(raw=start["headers"])
+            headers["Content-Encoding"] = "gzip"
+            headers.add_vary_header("Accept-Encoding")
+            if "content-length" in headers:
+                del headers["content-length"]
+            self.compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, _GZIP_WBITS)
+            await self.send(start)
+
+        # Z_SYNC_FLUSH: output ends on a byte boundary the client can decode now
+        body = self.compressor.compress(body) + self.compressor.flush(
+            zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH
+        )
+        await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+
+class StreamingGZipMiddleware:
+    """
+    GZip that keeps NDJSON streams live.
+
+    Starlette's GZipMiddleware leaves streamed chunks in zlib's buffer, so a
+    client would see no events until kilobytes had piled up, or the stream
+    ended. Here every chunk is sync-flushed as it is sent: each event still
+    arrives on its own, while repeated keys ("type", "node", ...) compress
+    across the whole stream. Server-Sent Events are never compressed.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 500, compresslevel: int = 9) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = _StreamingGZipResponder(self.app, self.minimum_size, self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
@@ -0,0 +1,49 @@
+# app/sse.py
+
+import asyncio
+from typing import AsyncIterator
+
+SSE_MEDIA_TYPE = "text/event-stream"
+
+# A comment line: keeps idle connections open and is ignored by EventSource
+_PING = b": ping\n\n"
+
+
+async def _next(events: AsyncIterator[bytes]) -> bytes:
+    return await events.__anext__()
+
+
+async def ndjson_to_sse(events: AsyncIterator[bytes], ping_interval: float = 15.0) -> AsyncIterator[bytes]:
+    """
+    Re-frame an NDJSON event stream as Server-Sent Events.
+
+    Each NDJSON line becomes one "data:" event as-is, so events are never
+    decoded or serialized a second time. When the stream is quiet for
+    ping_interval seconds (e.g. during a long LLM call) a ping comment is
+    sent, so proxies don't drop the connection as idle.
+    """
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(_next(events))
+
+            done, _ = await asyncio.wait({pending}, timeout=ping_interval)
+            if not done:
+                yield _PING
+                continue
+
+            finished, pending = pending, None
+            try:
+                chunk = finished.result()
+            except StopAsyncIteration:
+                return
+
+            yield b"".join(b"data: " + line + b"\n\n" for line in chunk.splitlines())
+    finally:
+        if pending is not None:
+            # The client went away while an event was being produced
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        # Close the source now, so its cleanup (e.g. stopping the graph) doesn't wait for GC
+        await events.aclose()
@@ -11,6 +11,8 @@ interface StreamEvent {
   args?: any
   thread_id?: string
   question?: string
+  name?: string
+  value?: any
 }
 
 function App() {
@@ -301,6 +303,17 @@ function App() {
           </div>
         )
 
+      case 'field':
+        return (
+          <div key={index} className="event-card default-card">
+            <div className="event-icon">✏️</div>
+            <div className="event-content">
+              <div className="event-type">Classifying: {event.name}</div>
+              <div className="event-message">{String(event.value)}</div>
+            </div>
+          </div>
+        )
+
       case 'error':
         return (
           <div key={index} className="event-card error-card">
@@ -0,0 +1,93 @@
+# kb/embedding_batcher.py
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+EmbedMany = Callable[[List[str], str], Awaitable[List[List[float]]]]
+
+
+class EmbeddingBatcher:
+    """
+    Microbatcher for embedding requests.
+
+    Texts submitted by concurrent callers within max_wait seconds of each
+    other (or until max_batch of them are waiting) go to the embeddings API
+    in one request, so a burst of tickets costs one round trip instead of
+    one per ticket. Each caller still gets back just its own embedding.
+
+    Args:
+        embed_many: Coroutine function taking (texts, model) and returning
+            their embeddings in order
+        max_batch: Most texts sent in one request
+        max_wait: Seconds the first text of a batch waits for others
+    """
+
+    def __init__(self, embed_many: EmbedMany, max_batch: int = 128, max_wait: float = 0.005):
+        self.embed_many = embed_many
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending: List[Tuple[str, str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Keeps in-flight requests referenced until they finish
+        self._requests: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str, model: str) -> List[float]:
+        """Embed one text as part of the next batch."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((model, text, future))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            request = asyncio.ensure_future(self._send(batch))
+            self._requests.add(request)
+            request.add_done_callback(self._requests.discard)
+
+    async def _send(self, batch: List[Tuple[str, str, asyncio.Future]]) -> None:
+        try:
+            # Unique texts per model, in submission order
+            by_model = {}
+            for model, text, _ in batch:
+                by_model.setdefault(model, {})[text] = None
+
+            results = {}
+            for model, texts in by_model.items():
+                texts = list(texts)
+                try:
+                    embeddings = await self.embed_many(texts, model)
+                    if len(embeddings) != len(texts):
+                        raise ValueError(f"Got {len(embeddings)} embeddings for {len(texts)} texts")
+                except Exception as e:
+                    logger.error(f"Error getting embeddings for a batch of {len(texts)}: {e}")
+                    embeddings = [e] * len(texts)
+                results.update(((model, text), embedding) for text, embedding in zip(texts, embeddings))
+
+            for model, text, future in batch:
+                if future.done():
+                    # The caller was cancelled while waiting
+                    continue
+                result = results[(model, text)]
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            # Whatever went wrong above (even cancellation), no caller is left waiting
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Embedding batch did not complete"))
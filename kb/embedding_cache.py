@@ -0,0 +1,118 @@
+# kb/embedding_cache.py
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    Two-level cache of embeddings: a bounded in-memory LRU in front of an
+    optional SQLite file, so a restarted process reads repeated texts from
+    disk instead of calling the embeddings API again.
+
+    Entries are keyed by sha256(model + text), so switching embedding models
+    never returns vectors from the old one. Vectors are stored as raw float32
+    bytes rather than pickles.
+
+    Args:
+        max_size: Maximum number of embeddings kept in memory
+        path: SQLite file for the on-disk layer; empty to keep memory only
+    """
+
+    def __init__(self, max_size: int = 10000, path: str = ""):
+        self.max_size = max_size
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = self._open(path) if path else None
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    def get_many(self, model: str, texts: Iterable[str]) -> Dict[str, List[float]]:
+        """Return the cached embeddings of the given texts; misses are left out."""
+        keys = {self._key(model, text): text for text in texts}
+        found = {}
+
+        with self._lock:
+            for key, text in keys.items():
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[text] = self._memory[key]
+
+            missing = [key for key in keys if keys[key] not in found]
+            if missing and self._db is not None:
+                for key, blob in self._select(missing):
+                    embedding = array('f', blob).tolist()
+                    self._remember(key, embedding)
+                    found[keys[key]] = embedding
+
+        return found
+
+    def put_many(self, model: str, items: Iterable[Tuple[str, List[float]]]) -> None:
+        """Cache embeddings in memory and, if enabled, on disk."""
+        rows = []
+        with self._lock:
+            for text, embedding in items:
+                key = self._key(model, text)
+                self._remember(key, embedding)
+                rows.append((key, array('f', embedding).tobytes()))
+
+            if rows and self._db is not None:
+                try:
+                    with self._db:
+                        self._db.executemany(
+                            "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows
+                        )
+                except sqlite3.Error as e:
+                    logger.warning(f"Could not write embedding cache: {e}")
+
+    def clear(self) -> None:
+        """Drop the in-memory layer; the on-disk layer is kept."""
+        with self._lock:
+            self._memory.clear()
+
+    def _remember(self, key: str, embedding: List[float]) -> None:
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def _select(self, keys: List[str]) -> List[Tuple[str, bytes]]:
+        rows = []
+        try:
+            # Stay well under SQLite's limit on bound parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ", ".join("?" * len(batch))
+                rows += self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not read embedding cache: {e}")
+        return rows
+
+    @staticmethod
+    def _open(path: str) -> Optional[sqlite3.Connection]:
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            return db
+        except (OSError, sqlite3.Error) as e:
+            # Fall back to memory only rather than failing KB search
+            logger.warning(f"Embedding cache disabled, could not open {path}: {e}")
+            return None
+
+    @staticmethod
+    def _key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
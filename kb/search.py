@@ -1,81 +1,433 @@
-import json
+import asyncio
+import hashlib
 import logging
-from typing import List, Dict
+import os
+import re
+import sqlite3
+import sys
+import threading
+from functools import cached_property, lru_cache
+from typing import List, Dict, NamedTuple, Optional
 import numpy as np
-from openai import OpenAI
+import orjson
+from openai import OpenAI, AsyncOpenAI
 from app.config import get_settings
+from agent.clients import get_openai, get_async_openai
+from agent.utils import retry_with_backoff, retry_with_backoff_async
+from kb.embedding_cache import EmbeddingCache
+from kb.embedding_batcher import EmbeddingBatcher
 
 logger = logging.getLogger(__name__)
 
+# Reciprocal rank fusion constant, as in the original RRF paper
+RRF_K = 60
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Most inputs the embeddings API accepts in one request
+EMBEDDING_BATCH_SIZE = 2048
+
+# Entries short-listed by the int8 scan and rescored with float32 vectors
+RERANK_CANDIDATES = 20
+
+
+class SearchIndex(NamedTuple):
+    """Everything KnowledgeBase.search needs, built once from the KB entries."""
+    entries: List[Dict]
+    quantized: Optional[np.ndarray]  # int8 unit-length embeddings, one row per entry (None for float32 scans)
+    scales: Optional[np.ndarray]  # per-row int8 scale factors
+    vectors: Optional[np.ndarray]  # float32 unit-length embeddings, for reranking
+    keywords: Optional[sqlite3.Connection]  # FTS5 table over titles and symptoms
+
 
 class KnowledgeBase:
     def __init__(self):
         settings = get_settings()
         self.kb_path = settings.KB_PATH
-        self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
-        self.embeddings_cache = {}
+        self.hot_reload = settings.KB_HOT_RELOAD
+        self._kb_mtime: Optional[float] = None  # mtime of the file the entries came from
+        self.embeddings_dir = settings.KB_EMBEDDINGS_DIR
+        self.embedding_dtype = settings.KB_EMBEDDING_DTYPE
+        self.batcher = EmbeddingBatcher(
+            self._acreate_embeddings,
+            max_batch=settings.EMBEDDING_MICROBATCH_SIZE,
+            max_wait=settings.EMBEDDING_MICROBATCH_WAIT
+        )
+        self.embeddings_cache = EmbeddingCache(
+            max_size=settings.EMBEDDING_CACHE_SIZE,
+            path=settings.EMBEDDING_CACHE_PATH
+        )
+        self._index: Optional[SearchIndex] = None
+        self.snapshot = 0  # Bumped whenever the entries are (re)loaded
+        self._keyword_lock = threading.Lock()
     
     def load_kb(self) -> List[Dict]:
         try:
-            with open(self.kb_path, 'r') as f:
-                return json.load(f)
+            with open(self.kb_path, 'rb') as f:
+                self._kb_mtime = os.fstat(f.fileno()).st_mtime
+                return orjson.loads(f.read())
         except Exception as e:
             logger.error(f"Error loading KB: {e}")
             return []
     
+    # Process-wide clients, shared with the LLM and looked up on each use, so
+    # clients rebuilt after close_openai_clients() are picked up. Retries are
+    # handled by retry_with_backoff
+    @property
+    def client(self) -> OpenAI:
+        return get_openai()
+    
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        """Used by aembed, which batches concurrent callers into one request."""
+        return get_async_openai()
+    
+    @cached_property
+    def entries(self) -> List[Dict]:
+        """KB entries, read from disk on first use and kept until the file changes (see reload_if_changed)."""
+        entries = self.load_kb()
+        self.snapshot += 1
+        self.__dict__.pop('entries_by_id', None)
+        self.__dict__.pop('entry_texts', None)
+        return entries
+    
+    def reload_if_changed(self) -> bool:
+        """
+        With KB_HOT_RELOAD on, drop the entries and index if the KB file was
+        modified since it was loaded, so the next search picks up the edit.
+        Costs one stat() per search, which is why it is off by default.
+        """
+        if not self.hot_reload or self._kb_mtime is None:
+            return False
+        
+        try:
+            mtime = os.stat(self.kb_path).st_mtime
+        except OSError:
+            return False
+        if mtime == self._kb_mtime:
+            return False
+        
+        logger.info(f"KB file {self.kb_path} changed, reloading")
+        self._kb_mtime = None
+        self._index = None
+        self.__dict__.pop('entries', None)
+        return True
+    
+    @cached_property
+    def entries_by_id(self) -> Dict[str, Dict]:
+        return {entry['id']: entry for entry in self.entries}
+    
+    @cached_property
+    def entry_texts(self) -> List[str]:
+        """Embedding text of each entry, in KB order; built once per load of the KB."""
+        return [sys.intern(self._build_entry_text(entry)) for entry in self.entries]
+    
     def search(self, query: str, top_k: int = 3):
-        kb_entries = self.load_kb()
-        query_embedding = self._get_embedding(query)
-        results = []
-        
-        for entry in kb_entries:
-            entry_text = self._build_entry_text(entry)
-            entry_embedding = self._get_embedding(entry_text)
-            score = self._cosine_similarity(query_embedding, entry_embedding)
-            
-            results.append({
-                'id': entry['id'],
-                'title': entry['title'],
-                'category': entry['category'],
-                'score': score,
-                'recommended_action': entry.get('recommended_action', '')
-            })
-        
-        results.sort(key=lambda x: x['score'], reverse=True)
-        return results[:top_k]
+        """
+        Hybrid search: rank entries by embedding similarity and by BM25 keyword
+        match, then merge both rankings with reciprocal rank fusion. Exact terms
+        such as error codes are found by BM25 even when the embeddings miss them.
+        
+        The returned 'score' is still the cosine similarity, since that is what
+        the known_issue threshold is defined on.
+        """
+        self.reload_if_changed()
+        index = self._get_index()
+        if not index.entries:
+            return []
+        return self._rank(index, query, self._get_embedding(query), top_k)
     
-    def _build_entry_text(self, entry: Dict) -> str:
-        text = entry['title']
-        symptoms = entry.get('symptoms', [])
-        if symptoms:
-            text += ' ' + ' '.join(symptoms)
-        return text
+    async def asearch(self, query: str, top_k: int = 3):
+        """
+        Async search. The query is embedded with aembed, so concurrent searches
+        share one embeddings request; only the one-time index build runs in a
+        worker thread.
+        """
+        self.reload_if_changed()
+        index = self._index
+        if index is None:
+            index = await asyncio.to_thread(self._get_index)
+        if not index.entries:
+            return []
+        return self._rank(index, query, await self.aembed(query), top_k)
+    
+    async def warmup(self) -> None:
+        """
+        Load the entries and build the index (or map the saved embeddings) now,
+        so the first ticket doesn't pay for it, then run the ranking path once.
+        """
+        index = await asyncio.to_thread(self._get_index)
+        if index.entries:
+            # An entry's own vector as the query exercises the int8 scan, rerank and FTS
+            self._rank(index, index.entries[0]['title'], index.vectors[0], 1)
+    
+    def _rank(self, index: SearchIndex, query: str, embedding: List[float], top_k: int):
+        """Fuse the keyword and vector rankings of the query and return the top_k hits."""
+        entries = index.entries
+        query_vector = self._normalize(np.asarray(embedding, dtype=np.float32))
+        
+        rankings = [self._keyword_search(index.keywords, query)]
+        if query_vector.any():
+            # A zero query vector means embedding failed, so its ranking is meaningless
+            rankings.append(self._vector_search(index, query_vector))
+        
+        # Positions within a ranking are unique, so fancy-index += adds each once
+        fused = np.zeros(len(entries))
+        for ranking in rankings:
+            fused[ranking] += 1.0 / (RRF_K + np.arange(1, len(ranking) + 1))
+        
+        top = self._top_k(fused, top_k)
+        scores = index.vectors[top] @ query_vector
+        
+        return [
+            {
+                'id': entries[i]['id'],
+                'title': entries[i]['title'],
+                'category': entries[i]['category'],
+                'score': float(score),
+                'recommended_action': entries[i].get('recommended_action', '')
+            }
+            for i, score in zip(top, scores)
+        ]
     
-    def _get_embedding(self, text: str) -> List[float]:
-        if text in self.embeddings_cache:
-            return self.embeddings_cache[text]
+    def _vector_search(self, index: SearchIndex, query_vector: np.ndarray) -> np.ndarray:
+        """
+        Return entry positions ranked by cosine similarity to the query.
+        
+        The full scan runs over the int8 matrix, which moves 4x fewer bytes than
+        float32. Only the best RERANK_CANDIDATES are rescored with the float32
+        vectors, so the final order does not suffer from quantization error.
+        With KB_EMBEDDING_DTYPE=float32 the scan is exact and there is no rerank.
+        """
+        if index.quantized is None:
+            return self._top_k(index.vectors @ query_vector, RERANK_CANDIDATES)
+        
+        query_i8, query_scale = self._quantize(query_vector)
+        
+        # Dot products of unit vectors are cosine similarities; accumulate in
+        # int32 so the int8 products can't overflow, then undo both scales
+        approx = np.matmul(index.quantized, query_i8, dtype=np.int32) / (index.scales * query_scale)
+        candidates = self._top_k(approx, RERANK_CANDIDATES)
+        
+        exact = index.vectors[candidates] @ query_vector
+        return candidates[np.argsort(-exact, kind="stable")]
+    
+    def _get_index(self) -> SearchIndex:
+        """
+        Return the KB entries with their embeddings (int8 for scanning, float32
+        for reranking) and a full-text index over their titles and symptoms.
+        
+        The index is built once and reused for every search. If any entry could
+        not be embedded it is rebuilt on the next search rather than caching a
+        zero vector for good.
+        """
+        if self._index is not None:
+            return self._index
+        
+        entries = self.entries
+        if not entries:
+            # Don't keep a failed load around; try the file again next time
+            self.__dict__.pop('entries', None)
+            return SearchIndex(entries, None, None, None, None)
+        
+        texts = self.entry_texts
+        matrix = self._load_kb_embeddings(texts)
+        complete = matrix is not None
+        
+        if matrix is None:
+            embeddings = self._get_embeddings(texts)
+            matrix = self._normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(entries), -1))
+            complete = all(any(embedding) for embedding in embeddings)
+            if complete:
+                self._save_kb_embeddings(texts, matrix)
+        
+        quantized, scales = self._quantize(matrix) if self.embedding_dtype == "int8" else (None, None)
+        index = SearchIndex(entries, quantized, scales, matrix, self._build_keyword_index(entries))
+        
+        if complete:
+            self._index = index
+        
+        return index
+    
+    def _embeddings_path(self, texts: List[str]) -> Optional[str]:
+        """File for the KB embedding matrix, named after the model and entry texts it encodes."""
+        if not self.embeddings_dir:
+            return None
+        digest = hashlib.sha256(EMBEDDING_MODEL.encode())
+        for text in texts:
+            digest.update(b"\0" + text.encode())
+        return os.path.join(self.embeddings_dir, f"kb_embeddings_{digest.hexdigest()[:16]}.npy")
+    
+    def _load_kb_embeddings(self, texts: List[str]) -> Optional[np.ndarray]:
+        """
+        Load previously saved KB embeddings, memory-mapped, so restarts don't
+        re-embed the KB. Any change to the entries changes the file name.
+        """
+        path = self._embeddings_path(texts)
+        if path is None or not os.path.exists(path):
+            return None
+        
+        try:
+            matrix = np.load(path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable KB embeddings {path}: {e}")
+            return None
+        
+        if matrix.shape[0] != len(texts) or matrix.dtype != np.float32:
+            return None
+        return matrix
+    
+    def _save_kb_embeddings(self, texts: List[str], matrix: np.ndarray) -> None:
+        path = self._embeddings_path(texts)
+        if path is None:
+            return
+        try:
+            np.save(path, np.ascontiguousarray(matrix, dtype=np.float32))
+        except OSError as e:
+            # A read-only deployment just embeds the KB once per process
+            logger.warning(f"Could not save KB embeddings to {path}: {e}")
+    
+    def _build_keyword_index(self, entries: List[Dict]) -> sqlite3.Connection:
+        """Build an in-memory SQLite FTS5 table mirroring the KB entries."""
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
+        connection.execute("CREATE VIRTUAL TABLE kb_fts USING fts5(title, symptoms)")
+        connection.executemany(
+            "INSERT INTO kb_fts (rowid, title, symptoms) VALUES (?, ?, ?)",
+            [
+                (i, entry['title'], ' '.join(entry.get('symptoms', [])))
+                for i, entry in enumerate(entries)
+            ]
+        )
+        return connection
+    
+    def _keyword_search(self, keyword_index: sqlite3.Connection, query: str) -> List[int]:
+        """Return entry positions matching any query term, best BM25 score first."""
+        terms = re.findall(r"\w+", query.lower())
+        if not terms:
+            return []
+        
+        # Quote each term so user input can't be parsed as FTS5 query syntax
+        match = " OR ".join(f'"{term}"' for term in terms)
+        
+        try:
+            with self._keyword_lock:
+                rows = keyword_index.execute(
+                    "SELECT rowid FROM kb_fts WHERE kb_fts MATCH ? ORDER BY bm25(kb_fts)",
+                    (match,)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error in keyword search: {e}")
+            return []
+        
+        return [row[0] for row in rows]
+    
+    def embed(self, text: str, model: str = EMBEDDING_MODEL) -> List[float]:
+        """Embed text with the same model and cache used for KB search."""
+        return self._get_embedding(text, model)
+    
+    async def aembed(self, text: str, model: str = EMBEDDING_MODEL) -> List[float]:
+        """
+        Async embed. Cache misses from concurrent callers are sent to the API
+        together, and the result lands in the same cache KB search reads.
+        """
+        cached = self.embeddings_cache.get_many(model, [text])
+        if text in cached:
+            return cached[text]
         
         try:
-            response = self.client.embeddings.create(
-                model="text-embedding-3-small",
-                input=text
-            )
-            embedding = response.data[0].embedding
-            self.embeddings_cache[text] = embedding
-            return embedding
+            embedding = await self.batcher.embed(text, model)
         except Exception as e:
             logger.error(f"Error getting embedding: {e}")
             return [0.0] * 1536
+        
+        self.embeddings_cache.put_many(model, [(text, embedding)])
+        return embedding
+    
+    def _build_entry_text(self, entry: Dict) -> str:
+        symptoms = entry.get('symptoms')
+        if not symptoms:
+            return entry['title']
+        return f"{entry['title']} {' '.join(symptoms)}"
     
-    def _cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
-        vec1 = np.array(vec1)
-        vec2 = np.array(vec2)
+    def _get_embedding(self, text: str, model: str = EMBEDDING_MODEL) -> List[float]:
+        return self._get_embeddings([text], model)[0]
+    
+    def _get_embeddings(self, texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+        """
+        Embed texts, checking the memory and disk cache first and sending all
+        remaining ones in as few API requests as possible.
+        """
+        found = self.embeddings_cache.get_many(model, texts)
+        missing = list(dict.fromkeys(text for text in texts if text not in found))
         
-        dot_product = np.dot(vec1, vec2)
-        norm1 = np.linalg.norm(vec1)
-        norm2 = np.linalg.norm(vec2)
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+            try:
+                embeddings = list(zip(batch, self._create_embeddings(batch, model)))
+            except Exception as e:
+                logger.error(f"Error getting embeddings: {e}")
+                continue
+            self.embeddings_cache.put_many(model, embeddings)
+            found.update(embeddings)
         
-        if norm1 == 0 or norm2 == 0:
-            return 0.0
+        return [found.get(text, [0.0] * 1536) for text in texts]
+    
+    @retry_with_backoff()
+    def _create_embeddings(self, texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+        response = self.client.embeddings.create(
+            model=model,
+            input=texts
+        )
+        # Results come back in input order, each tagged with its index
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    
+    @retry_with_backoff_async()
+    async def _acreate_embeddings(self, texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+        response = await self.async_client.embeddings.create(
+            model=model,
+            input=texts
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    
+    @staticmethod
+    def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Positions of the k highest scores, best first, ties in KB order.
         
-        return float(dot_product / (norm1 * norm2))  
\ No newline at end of file
+        partition finds the k-th best score in O(N); only entries scoring at
+        least that much (k, plus any tied with it) are then sorted.
+        """
+        if k <= 0:
+            return np.arange(0)
+        if k < len(scores):
+            kth = -np.partition(-scores, k - 1)[k - 1]
+            candidates = np.flatnonzero(scores >= kth)
+        else:
+            candidates = np.arange(len(scores))
+        return candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+    
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        """Scale vectors (or rows of a matrix) to unit length, leaving zero vectors as is."""
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+    
+    @staticmethod
+    def _quantize(vectors: np.ndarray):
+        """
+        Quantize vectors (or rows of a matrix) to int8, scaling each so its
+        largest component maps to 127. Returns the int8 values and the scales,
+        so that vectors ~= quantized / scale.
+        """
+        peaks = np.abs(vectors).max(axis=-1, keepdims=True)
+        peaks[peaks == 0] = 1.0
+        scales = 127.0 / peaks
+        quantized = np.ascontiguousarray(np.round(vectors * scales), dtype=np.int8)
+        return quantized, np.squeeze(scales, axis=-1).astype(np.float32)
+
+
+@lru_cache()
+def get_knowledge_base() -> KnowledgeBase:
+    """Process-wide KnowledgeBase, so the entries and embedding index are built once."""
+    return KnowledgeBase()
@@ -1,10 +1,19 @@
 import pytest
+import base64
 import os
-from unittest.mock import AsyncMock, Mock, patch
+import zlib
+import httpx
+import numpy as np
+import orjson
+from unittest.mock import Mock, patch
 
 # Set test environment
 os.environ["ENVIRONMENT"] = "test"
 os.environ["OPENAI_API_KEY"] = "sk-test-key-for-testing"
+# Tests embed the KB with fakes; don't let them save those next to the real KB
+os.environ["KB_EMBEDDINGS_DIR"] = ""
+os.environ["EMBEDDING_CACHE_PATH"] = ""
+os.environ["SEMANTIC_CACHE_PATH"] = ""
 
 
 @pytest.fixture
@@ -35,34 +44,123 @@ def mock_openai_client():
         yield mock
 
 
+# Canned OpenAI responses, serialized once for every test that uses them
+CANNED_CLASSIFICATION = orjson.dumps({
+    "summary": "Customer cannot update the credit card used for their subscription payment",
+    "category": "Billing",
+    "severity": "Medium",
+    "issue_type": "new_issue",
+    "next_action": "Route to the billing team to update the payment method",
+    "needs_more_info": False,
+    "clarifying_question": ""
+}).decode()
+
+
+def _chat_chunk(delta: dict, finish_reason=None) -> bytes:
+    return b"data: " + orjson.dumps({
+        "id": "chatcmpl-test",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }) + b"\n\n"
+
+
+CANNED_CHAT_STREAM = b"".join([
+    _chat_chunk({"role": "assistant", "content": ""}),
+    *(_chat_chunk({"content": CANNED_CLASSIFICATION[i:i + 16]}) for i in range(0, len(CANNED_CLASSIFICATION), 16)),
+    _chat_chunk({}, finish_reason="stop"),
+    b"data: [DONE]\n\n"
+])
+
+CANNED_CHAT_COMPLETION = orjson.dumps({
+    "id": "chatcmpl-test",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4o-mini",
+    "choices": [{
+        "index": 0,
+        "message": {"role": "assistant", "content": CANNED_CLASSIFICATION},
+        "finish_reason": "stop"
+    }],
+    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+})
+
+
+def _fake_embedding(text: str) -> np.ndarray:
+    """Bag-of-words vector, so texts sharing words stay similar."""
+    vector = np.zeros(1536, dtype=np.float32)
+    for word in text.lower().split():
+        vector[zlib.crc32(word.encode()) % 1536] += 1.0
+    return vector
+
+
+def _openai_response(request: httpx.Request) -> httpx.Response:
+    body = orjson.loads(request.content)
+    
+    if request.url.path.endswith("/embeddings"):
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        as_base64 = body.get("encoding_format") == "base64"
+        data = [
+            {
+                "object": "embedding",
+                "index": i,
+                "embedding": base64.b64encode(_fake_embedding(text).tobytes()).decode() if as_base64
+                else _fake_embedding(text).tolist()
+            }
+            for i, text in enumerate(texts)
+        ]
+        return httpx.Response(200, json={
+            "object": "list",
+            "data": data,
+            "model": body["model"],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0}
+        })
+    
+    if body.get("stream"):
+        return httpx.Response(200, content=CANNED_CHAT_STREAM, headers={"content-type": "text/event-stream"})
+    return httpx.Response(200, content=CANNED_CHAT_COMPLETION, headers={"content-type": "application/json"})
+
+
 @pytest.fixture
 def mock_async_openai_client():
-    """Mock AsyncOpenAI client for async testing"""
-    with patch("openai.AsyncOpenAI") as mock:
-        mock_instance = Mock()
-        
-        # Mock embeddings
-        mock_embeddings = Mock()
-        mock_embeddings.create = AsyncMock(return_value=Mock(
-            data=[Mock(embedding=[0.1] * 1536)]
-        ))
-        mock_instance.embeddings = mock_embeddings
-        
-        # Mock chat completions
-        mock_chat = Mock()
-        mock_completions = Mock()
-        mock_completions.create = AsyncMock(return_value=Mock(
-            choices=[Mock(
-                message=Mock(
-                    content='{"summary": "Test issue", "category": "Bug", "severity": "High", "issue_type": "known_issue", "next_action": "Test action"}'
-                )
-            )]
-        ))
-        mock_chat.completions = mock_completions
-        mock_instance.chat = mock_chat
-        
-        mock.return_value = mock_instance
-        yield mock
+    """
+    Serve the shared OpenAI clients from canned responses at the HTTP transport,
+    so the SDK, LangChain and the KB run unchanged without network access.
+    Yields the requests that were sent.
+    """
+    from agent.clients import get_openai, get_async_openai
+    
+    requests = []
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return _openai_response(request)
+    
+    transport = httpx.MockTransport(handler)
+    with patch.object(get_openai()._client, "_transport", transport), \
+            patch.object(get_async_openai()._client, "_transport", transport):
+        yield requests
+
+
+@pytest.fixture(scope="session")
+def client():
+    """TestClient running the app lifespan once for the whole session, so every test shares one TriageAgent"""
+    from fastapi.testclient import TestClient
+    from app.main import app
+    
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+async def async_client(client):
+    """httpx client calling the app in-process, so tests can send requests concurrently"""
+    from httpx import ASGITransport, AsyncClient
+    from app.main import app
+    
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        yield client
 
 
 @pytest.fixture(autouse=True)
@@ -1,25 +1,86 @@
 import pytest
 import json
+import orjson
+from typing import Final
+from unittest.mock import patch
 from fastapi.testclient import TestClient
 from app.main import app
+from app.config import get_settings
 from agent.orchestrator import TriageAgent
 
 
-client = TestClient(app)
+# Longest accepted description, built once and kept in step with the config
+_MAX_DESC: Final[str] = "A" * get_settings().MAX_DESCRIPTION_LENGTH
 
 
+def _ndjson_events(response) -> list:
+    """Decode an NDJSON response, reading it in large chunks and splitting lines with bytes.find"""
+    buffer = bytearray()
+    events = []
+    for chunk in response.iter_bytes(65536):
+        buffer.extend(chunk)
+        start = 0
+        while (end := buffer.find(b"\n", start)) != -1:
+            if end > start:
+                events.append(orjson.loads(buffer[start:end]))
+            start = end + 1
+        del buffer[:start]
+    if buffer.strip():
+        events.append(orjson.loads(buffer))
+    return events
+
 # ============================================================================
 # API Endpoint Tests
 # ============================================================================
 
-def test_health_check():
+def test_health_check(client):
     """Test health endpoint"""
     response = client.get("/health")
     assert response.status_code == 200
     assert response.json()["status"] == "healthy"
 
 
-def test_root_endpoint():
+def test_ready_after_warmup():
+    """Test /ready answers 503 until the KB warmup has finished"""
+    import asyncio
+    from unittest.mock import AsyncMock
+    import app.main as main_module
+    
+    kb = main_module.get_knowledge_base()
+    
+    async def slow_warmup():
+        await asyncio.sleep(3600)
+    
+    with patch.object(kb, "warmup", side_effect=slow_warmup), \
+            TestClient(app) as warming_client:
+        assert warming_client.get("/ready").status_code == 503
+    
+    with patch.object(kb, "warmup", new_callable=AsyncMock), \
+            TestClient(app) as warm_client:
+        assert warm_client.get("/ready").json() == {"status": "ready"}
+
+
+def test_hot_paths_stay_off_the_threadpool():
+    """Test the stream producers, dependency and probes are async, so Starlette never offloads them"""
+    import inspect
+    import app.main as main_module
+    
+    assert inspect.isasyncgenfunction(TriageAgent.triage_stream)
+    assert inspect.isasyncgenfunction(TriageAgent.resume_with_details)
+    for func in (main_module.get_agent, main_module.root, main_module.health, main_module.ready):
+        assert inspect.iscoroutinefunction(func)
+
+
+def test_agent_shared_across_requests(client):
+    """Test the app creates one TriageAgent at startup for all requests"""
+    agent = app.state.agent
+    
+    assert isinstance(agent, TriageAgent)
+    client.get("/health")
+    assert app.state.agent is agent
+
+
+def test_root_endpoint(client):
     """Test root endpoint"""
     response = client.get("/")
     assert response.status_code == 200
@@ -27,7 +88,7 @@ def test_root_endpoint():
 
 
 @pytest.mark.slow
-def test_triage_stream_basic(mock_async_openai_client):
+def test_triage_stream_basic(client, mock_async_openai_client):
     """Test basic streaming triage request with valid description"""
     payload = {"description": "Getting error 500 on mobile checkout"}
     response = client.post("/triage/stream", json=payload)
@@ -36,10 +97,7 @@ def test_triage_stream_basic(mock_async_openai_client):
     assert response.headers["content-type"] == "application/x-ndjson"
     
     # Parse NDJSON stream
-    events = []
-    for line in response.iter_lines():
-        if line:
-            events.append(json.loads(line))
+    events = _ndjson_events(response)
     
     assert len(events) > 0
     
@@ -48,7 +106,7 @@ def test_triage_stream_basic(mock_async_openai_client):
     assert "status" in event_types
 
 
-def test_triage_stream_empty_description():
+def test_triage_stream_empty_description(client):
     """Test triage with empty description returns 400"""
     payload = {"description": ""}
     response = client.post("/triage/stream", json=payload)
@@ -57,7 +115,7 @@ def test_triage_stream_empty_description():
     assert "empty" in response.json()["detail"].lower()
 
 
-def test_triage_stream_whitespace_only():
+def test_triage_stream_whitespace_only(client):
     """Test triage with whitespace-only description returns 400"""
     payload = {"description": "   \n\t  "}
     response = client.post("/triage/stream", json=payload)
@@ -65,9 +123,27 @@ def test_triage_stream_whitespace_only():
     assert response.status_code == 400
 
 
-def test_triage_stream_very_long_description():
+def test_triage_stream_other_validation_errors_stay_422(client):
+    """Test only description length/emptiness errors are mapped to 400"""
+    response = client.post("/triage/stream", json={"description": 42})
+    
+    assert response.status_code == 422
+
+
+def test_triage_request_drops_control_characters(client):
+    """Test control characters are removed from descriptions, keeping tabs and line breaks"""
+    from agent.models import TriageRequest
+    
+    assert TriageRequest(description="Login\x00 fails\x1b\tafter\nupdate\x7f").description == "Login fails\tafter\nupdate"
+    
+    response = client.post("/triage/stream", json={"description": "\x00\x08 \x1f"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Description cannot be empty"
+
+
+def test_triage_stream_very_long_description(client):
     """Test triage with description exceeding max length returns 400"""
-    payload = {"description": "A" * 10000}  # Exceeds MAX_DESCRIPTION_LENGTH
+    payload = {"description": _MAX_DESC + "A"}  # One past MAX_DESCRIPTION_LENGTH
     response = client.post("/triage/stream", json=payload)
     
     assert response.status_code == 400
@@ -75,30 +151,26 @@ def test_triage_stream_very_long_description():
 
 
 @pytest.mark.slow
-def test_triage_stream_specific_issue(mock_async_openai_client):
+def test_triage_stream_specific_issue(client, mock_async_openai_client):
     """Test triage with specific issue description"""
     payload = {"description": "Login fails with incorrect password error"}
     response = client.post("/triage/stream", json=payload)
     
     assert response.status_code == 200
     
-    events = []
+    events = _ndjson_events(response)
     classification_found = False
     
-    for line in response.iter_lines():
-        if line:
-            event = json.loads(line)
-            events.append(event)
-            
-            # Check if classification is present
-            if event.get("type") == "classification_complete":
-                classification = event["data"]
-                assert "summary" in classification
-                assert "category" in classification
-                assert "severity" in classification
-                assert "issue_type" in classification
-                assert "next_action" in classification
-                classification_found = True
+    for event in events:
+        # Check if classification is present
+        if event.get("type") == "classification_complete":
+            classification = event["data"]
+            assert "summary" in classification
+            assert "category" in classification
+            assert "severity" in classification
+            assert "issue_type" in classification
+            assert "next_action" in classification
+            classification_found = True
     
     # Should either have classification or interrupt
     event_types = [e["type"] for e in events]
@@ -106,24 +178,21 @@ def test_triage_stream_specific_issue(mock_async_openai_client):
 
 
 @pytest.mark.slow
-def test_triage_stream_vague_query(mock_async_openai_client):
+def test_triage_stream_vague_query(client, mock_async_openai_client):
     """Test triage with vague query might trigger interrupt"""
     payload = {"description": "help"}
     response = client.post("/triage/stream", json=payload)
     
     assert response.status_code == 200
     
-    events = []
-    for line in response.iter_lines():
-        if line:
-            events.append(json.loads(line))
+    events = _ndjson_events(response)
     
     # Check if interrupt or classification event is present
     event_types = [event["type"] for event in events]
     assert len(event_types) > 0
 
 
-def test_resume_endpoint_missing_thread_id():
+def test_resume_endpoint_missing_thread_id(client):
     """Test resume endpoint without thread_id returns 400"""
     payload = {"thread_id": "", "additional_details": "Some details"}
     response = client.post("/triage/resume", json=payload)
@@ -131,7 +200,7 @@ def test_resume_endpoint_missing_thread_id():
     assert response.status_code == 400
 
 
-def test_resume_endpoint_empty_details():
+def test_resume_endpoint_empty_details(client):
     """Test resume endpoint with empty additional_details returns 400"""
     payload = {"thread_id": "test-123", "additional_details": ""}
     response = client.post("/triage/resume", json=payload)
@@ -139,6 +208,142 @@ def test_resume_endpoint_empty_details():
     assert response.status_code == 400
 
 
+@pytest.mark.asyncio
+async def test_gzip_middleware_flushes_each_streamed_chunk():
+    """Test gzip streams stay live: every chunk decodes as soon as it is sent"""
+    import zlib
+    from fastapi.responses import StreamingResponse
+    from app.middleware import StreamingGZipMiddleware
+    
+    async def events():
+        yield b'{"type":"status","message":"' + b"x" * 600 + b'"}\n'
+        yield b'{"type":"node_start","node":"search_kb"}\n'
+    
+    sent = []
+    
+    async def send(message):
+        sent.append(message)
+    
+    async def receive():
+        return {"type": "http.disconnect"}
+    
+    middleware = StreamingGZipMiddleware(StreamingResponse(events(), media_type="application/x-ndjson"), minimum_size=512)
+    await middleware({"type": "http", "headers": [(b"accept-encoding", b"gzip")]}, receive, send)
+    
+    assert (b"content-encoding", b"gzip") in sent[0]["headers"]
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = [decoder.decompress(message["body"]) for message in sent[1:] if message.get("body")]
+    assert chunks[0].startswith(b'{"type":"status"')
+    assert chunks[1] == b'{"type":"node_start","node":"search_kb"}\n'
+    assert decoder.eof
+
+
+@pytest.mark.asyncio
+async def test_gzip_middleware_leaves_sse_uncompressed():
+    """Test Server-Sent Events pass through the gzip middleware untouched"""
+    from fastapi.responses import StreamingResponse
+    from app.middleware import StreamingGZipMiddleware
+    from app.sse import SSE_MEDIA_TYPE
+    
+    async def events():
+        yield b"data: " + b"x" * 600 + b"\n\n"
+        yield b": ping\n\n"
+    
+    sent = []
+    
+    async def send(message):
+        sent.append(message)
+    
+    async def receive():
+        return {"type": "http.disconnect"}
+    
+    middleware = StreamingGZipMiddleware(StreamingResponse(events(), media_type=SSE_MEDIA_TYPE), minimum_size=512)
+    await middleware({"type": "http", "headers": [(b"accept-encoding", b"gzip")]}, receive, send)
+    
+    assert all(name != b"content-encoding" for name, _ in sent[0]["headers"])
+    assert b"".join(message.get("body", b"") for message in sent[1:]) == b"data: " + b"x" * 600 + b"\n\n: ping\n\n"
+
+
+def test_triage_stream_disables_proxy_buffering(client):
+    """Test NDJSON streams tell proxies and caches not to hold events back"""
+    async def fake_stream(description):
+        yield b'{"type":"status","message":"working"}\n'
+    
+    with patch.object(app.state.agent, "triage_stream", side_effect=fake_stream):
+        response = client.post("/triage/stream", json={"description": "Login fails"})
+    
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.headers["x-accel-buffering"] == "no"
+    assert response.headers["cache-control"] == "no-cache"
+
+
+def test_triage_stream_serves_sse_on_request(client):
+    """Test Accept: text/event-stream gets each NDJSON event as an SSE data event"""
+    async def fake_stream(description):
+        yield b'{"type":"status","message":"working"}\n'
+        yield b'{"type":"kb_search_complete","data":""}\n{"type":"status","message":"Triage complete"}\n'
+    
+    with patch.object(app.state.agent, "triage_stream", side_effect=fake_stream):
+        response = client.post(
+            "/triage/stream",
+            json={"description": "Login fails"},
+            headers={"Accept": "text/event-stream"}
+        )
+    
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.headers["x-accel-buffering"] == "no"
+    assert response.text == (
+        'data: {"type":"status","message":"working"}\n\n'
+        'data: {"type":"kb_search_complete","data":""}\n\n'
+        'data: {"type":"status","message":"Triage complete"}\n\n'
+    )
+
+
+@pytest.mark.asyncio
+async def test_sse_stream_pings_while_idle():
+    """Test a quiet SSE stream sends keep-alive comments until the next event"""
+    import asyncio
+    from app.sse import ndjson_to_sse
+    
+    async def slow_events():
+        await asyncio.sleep(0.05)
+        yield b'{"type":"status"}\n'
+    
+    chunks = [chunk async for chunk in ndjson_to_sse(slow_events(), ping_interval=0.02)]
+    
+    assert chunks[0] == b": ping\n\n"
+    assert chunks[-1] == b'data: {"type":"status"}\n\n'
+
+
+@pytest.mark.asyncio
+async def test_sse_stream_stops_the_graph_when_the_client_leaves():
+    """Test closing the SSE stream early closes the triage stream and cancels its graph task"""
+    import asyncio
+    import agent.orchestrator as orchestrator_module
+    from app.sse import ndjson_to_sse
+    
+    agent = TriageAgent()
+    cancelled = asyncio.Event()
+    
+    async def fake_astream(stream_input, config, stream_mode):
+        yield "updates", {"search_kb": {"kb_results": "Found related known issues:\n"}}
+        try:
+            await asyncio.Event().wait()  # an LLM call that is still running
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+    
+    with patch.object(orchestrator_module.kb, "aembed", return_value=[1.0, 0.0]), \
+            patch.object(orchestrator_module.graph, "astream", side_effect=fake_astream):
+        events = ndjson_to_sse(agent.triage_stream("Checkout page shows a blank screen"), ping_interval=60)
+        await anext(events)
+        await anext(events)  # the graph is now running
+        await events.aclose()
+    
+    assert cancelled.is_set()
+    assert agent._inflight == {}
+
+
 # ============================================================================
 # Agent Logic Tests
 # ============================================================================
@@ -151,7 +356,7 @@ async def test_agent_triage_stream():
     
     events = []
     async for event_str in agent.triage_stream(description):
-        event = json.loads(event_str.strip())
+        event = orjson.loads(event_str.strip())
         events.append(event)
     
     assert len(events) > 0
@@ -169,7 +374,7 @@ async def test_agent_triage_contains_kb_search():
     
     events = []
     async for event_str in agent.triage_stream(description):
-        event = json.loads(event_str.strip())
+        event = orjson.loads(event_str.strip())
         events.append(event)
     
     # Should have KB search node
@@ -180,18 +385,17 @@ async def test_agent_triage_contains_kb_search():
 
 
 @pytest.mark.asyncio
-async def test_agent_triage_classification_structure():
+async def test_agent_triage_classification_structure(mock_async_openai_client):
     """Test that classification has required fields"""
     agent = TriageAgent()
     description = "Unable to update billing information"
     
     classification = None
     async for event_str in agent.triage_stream(description):
-        event = json.loads(event_str.strip())
+        event = orjson.loads(event_str.strip())
         
         if event.get("type") == "classification_complete":
             classification = event.get("data")
-            break
     
     # Verify classification structure if not interrupted
     if classification:
@@ -202,44 +406,1117 @@ async def test_agent_triage_classification_structure():
         assert classification["severity"] in ["Low", "Medium", "High", "Critical"]
 
 
+@pytest.mark.asyncio
+async def test_agent_triage_batch():
+    """Test batch triage classifies every ticket and falls back per ticket"""
+    from langchain_core.messages import AIMessage
+    import agent.graph as graph_module
+    import agent.orchestrator as orchestrator_module
+    
+    async def fake_llm(llm, messages):
+        if llm.kwargs["response_format"]["json_schema"]["name"] == "BatchClassification":
+            # Ticket 2 is missing from the batch response
+            return AIMessage(content=json.dumps({"classifications": [{
+                "ticket": 1, "summary": "Card update fails", "category": "Billing",
+                "severity": "Medium", "issue_type": "known_issue", "next_action": "Attach KB article ISSUE-104"
+            }]}))
+        return AIMessage(content=json.dumps({
+            "summary": "Slow dashboard", "category": "Performance", "severity": "Low",
+            "issue_type": "new_issue", "next_action": "Escalate to infra team",
+            "needs_more_info": False, "clarifying_question": ""
+        }))
+    
+    kb_hits = [{"id": "ISSUE-104", "title": "Unable to update billing information",
+                "category": "Billing", "score": 0.8, "recommended_action": "Verify payment gateway"}]
+    
+    with patch.object(graph_module, "call_llm_with_retry", fake_llm), \
+            patch.object(orchestrator_module.kb, "aembed", return_value=[0.0] * 1536), \
+            patch.object(orchestrator_module.kb, "asearch", return_value=kb_hits):
+        responses = await TriageAgent().triage_batch(
+            ["Cannot update my credit card", "Dashboard is slow"]
+        )
+    
+    assert [r.category.value for r in responses] == ["Billing", "Performance"]
+    assert responses[0].related_issues[0].id == "ISSUE-104"
+
+
+@pytest.mark.asyncio
+async def test_classify_batch_skips_malformed_items():
+    """Test one malformed item in a batch response doesn't discard the others"""
+    from langchain_core.messages import AIMessage
+    import agent.graph as graph_module
+    
+    item = {"summary": "Card update fails", "category": "Billing", "severity": "Medium",
+            "issue_type": "known_issue", "next_action": "Attach KB article ISSUE-104"}
+    
+    async def fake_llm(llm, messages):
+        return AIMessage(content=json.dumps({"classifications": [
+            {"summary": "No ticket number"}, "not an object", dict(item, ticket="two"), dict(item, ticket=1)
+        ]}))
+    
+    tickets = [{"description": "Cannot update my credit card", "kb_results": ""},
+               {"description": "Dashboard is slow", "kb_results": ""}]
+    with patch.object(graph_module, "call_llm_with_retry", fake_llm):
+        classifications = await graph_module.classify_batch(tickets)
+    
+    assert classifications == {1: item}
+
+
+def test_agent_rejects_invalid_batch_classification():
+    """Test classifications with unknown enum values are rejected before building a response"""
+    valid = {"summary": "Slow", "category": "Performance", "severity": "Low",
+             "issue_type": "new_issue", "next_action": "Escalate to backend team"}
+    
+    assert TriageAgent._build_response(valid, []).category.value == "Performance"
+    assert TriageAgent._build_response(dict(valid, category="Hardware"), []) is None
+    assert TriageAgent._build_response(dict(valid, severity=None), []) is None
+
+
+@pytest.mark.asyncio
+async def test_agent_triage_stream_serves_cache_hits():
+    """Test a near-duplicate ticket is answered from the semantic cache without the graph"""
+    import agent.orchestrator as orchestrator_module
+    
+    agent = TriageAgent()
+    classification = {"summary": "Password reset", "category": "Login", "severity": "Low",
+                      "issue_type": "known_issue", "next_action": "Attach KB article ISSUE-115"}
+    agent._cache_classification([1.0, 0.0], classification)
+    
+    with patch.object(orchestrator_module.kb, "aembed", return_value=[0.99, 0.01]), \
+            patch.object(orchestrator_module.kb, "asearch", return_value=[]):
+        events = [orjson.loads(line) async for line in agent.triage_stream("reset my password")]
+    
+    assert [e["type"] for e in events] == ["status", "kb_search_complete", "classification_complete", "status"]
+    assert events[2] == {"type": "classification_complete", "data": classification, "cached": True}
+
+
+@pytest.mark.asyncio
+async def test_agent_triage_stream_replays_cached_answer_in_one_write():
+    """Test a cache hit against the same KB snapshot is served without a KB search"""
+    import agent.orchestrator as orchestrator_module
+    
+    agent = TriageAgent()
+    classification = {"summary": "Password reset", "category": "Login", "severity": "Low",
+                      "issue_type": "known_issue", "next_action": "Attach KB article ISSUE-115"}
+    agent._cache_classification([1.0, 0.0], classification, "Found related known issues:\n")
+    
+    with patch.object(orchestrator_module.kb, "aembed", return_value=[0.99, 0.01]), \
+            patch.object(orchestrator_module.kb, "asearch") as mock_search:
+        chunks = [chunk async for chunk in agent.triage_stream("reset my password")]
+    
+    mock_search.assert_not_called()
+    assert len(chunks) == 2
+    events = [orjson.loads(line) for line in chunks[1].splitlines()]
+    assert [e["type"] for e in events] == ["kb_search_complete", "classification_complete", "status"]
+    assert events[0]["data"] == "Found related known issues:\n"
+
+
+def test_fast_router_only_routes_clear_cut_tickets():
+    """Test the keyword router needs several phrases of a single category"""
+    from agent.fast_router import FastRouter
+    
+    router = FastRouter(min_matches=2)
+    
+    assert router.match("Cannot update my Credit Card for subscription payment").category == "Billing"
+    assert router.match("Forgot my password and now I'm locked out").category == "Login"
+    assert router.match("Where is my invoice?") is None  # a single phrase
+    assert router.match("Can't log in to pay my invoice after a refund") is None  # two categories
+    assert router.match("Checkout fails with error 500") is None
+
+
+def test_fast_router_leaves_non_blockers_to_the_llm():
+    """Test only blocked tickets are routed, at the rubric's High, and how-tos and outages are not"""
+    from agent.fast_router import FastRouter
+    
+    router = FastRouter(min_matches=2)
+    
+    route = router.match("I was charged twice for my subscription, need a refund")
+    assert route.category == "Billing"
+    assert router.classify(route, "I was charged twice", [])["severity"] == "High"
+    assert router.match("My password reset link fails and I can't log in").severity == "High"
+    
+    assert router.match("how do I change my password after I log in") is None
+    assert router.match("How can I update my credit card for my subscription?") is None
+    assert router.match("Please send the invoice for my subscription") is None  # not blocked
+    assert router.match("Billing page fails for all users, every credit card is declined") is None
+
+
+@pytest.mark.asyncio
+async def test_agent_triage_stream_routes_keyword_tickets_without_llm():
+    """Test a routed ticket is classified from its keywords and KB hits, skipping the graph"""
+    import agent.orchestrator as orchestrator_module
+    from agent.fast_router import FastRouter
+    
+    agent = TriageAgent()
+    agent.fast_router = FastRouter()
+    kb_hits = [{"id": "ISSUE-104", "title": "Card update fails", "category": "Billing",
+                "score": 0.72, "recommended_action": "Escalate to billing"}]
+    
+    with patch.object(orchestrator_module.kb, "aembed", return_value=[1.0, 0.0]), \
+            patch.object(orchestrator_module.kb, "asearch", return_value=kb_hits), \
+            patch.object(agent, "_run_graph") as mock_graph:
+        events = [orjson.loads(line) async for line in agent.triage_stream("Cannot update my credit card for subscription payment")]
+    
+    mock_graph.assert_not_called()
+    assert [e["type"] for e in events] == ["status", "kb_search_complete", "classification_complete", "status"]
+    assert events[2]["routed"] is True
+    assert events[2]["data"] == {
+        "summary": "Cannot update my credit card for subscription payment",
+        "category": "Billing",
+        "severity": "High",
+        "issue_type": "known_issue",
+        "next_action": "Escalate to billing team; link to ISSUE-104"
+    }
+
+
+@pytest.mark.asyncio
+async def test_agent_triage_stream_runs_identical_tickets_once():
+    """Test a repeated description is answered by exact match and concurrent repeats share one graph run"""
+    import asyncio
+    import agent.orchestrator as orchestrator_module
+    
+    agent = TriageAgent()
+    classification = {"summary": "Password reset", "category": "Login", "severity": "Low",
+                      "issue_type": "known_issue", "next_action": "Attach KB article ISSUE-115"}
+    runs = []
+    
+    async def fake_graph_events(stream_input, config, thread_id, embedding, text_key=None, flight=None):
+        runs.append(text_key)
+        await asyncio.sleep(0.01)
+        agent._cache_classification(embedding, classification, "Found related known issues:\n", text_key)
+        yield b'{"type":"classification_complete"}\n'
+        yield b'{"type":"status","message":"Triage complete"}\n'
+    
+    async def triage(description):
+        return [chunk async for chunk in agent.triage_stream(description)]
+    
+    with patch.object(orchestrator_module.kb, "aembed", return_value=[1.0, 0.0]) as mock_embed, \
+            patch.object(agent, "_graph_events", side_effect=fake_graph_events):
+        await asyncio.gather(triage("Reset my password"), triage("reset my  password"))
+        assert len(runs) == 1
+        
+        mock_embed.reset_mock()
+        await triage("RESET my password")
+    
+    assert len(runs) == 1
+    mock_embed.assert_not_called()
+    assert agent._inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_agent_triage_stream_duplicates_do_not_wait_for_a_slow_reader():
+    """Test a repeat of an in-flight ticket gets its answer while the first client is still reading"""
+    import asyncio
+    from langchain_core.messages import AIMessage
+    import agent.orchestrator as orchestrator_module
+    
+    agent = TriageAgent()
+    classification = {"summary": "Password reset", "category": "Login", "severity": "Low",
+                      "issue_type": "known_issue", "next_action": "Attach KB article ISSUE-115"}
+    runs = []
+    
+    async def fake_astream(stream_input, config, stream_mode):
+        runs.append(stream_input)
+        yield "updates", {"search_kb": {"kb_results": "Found related known issues:\n"}}
+        message = AIMessage(content="", response_metadata={"finish_reason": "stop"})
+        yield "updates", {"classify": {"classification": classification, "messages": [message]}}
+        # More events than the stream queue holds, so the graph waits on its reader
+        for _ in range(orchestrator_module.STREAM_QUEUE_SIZE * 2):
+            yield "updates", {"classify": {}}
+    
+    async def triage(description):
+        return [chunk async for chunk in agent.triage_stream(description)]
+    
+    with patch.object(orchestrator_module.kb, "aembed", return_value=[1.0, 0.0]), \
+            patch.object(orchestrator_module.kb, "asearch", return_value=[]), \
+            patch.object(orchestrator_module.graph, "astream", side_effect=fake_astream):
+        stalled = agent.triage_stream("Reset my password")
+        await anext(stalled)
+        await anext(stalled)  # the first client reads two events, then stops reading
+        
+        repeat = await asyncio.wait_for(triage("reset my password"), timeout=1)
+        await stalled.aclose()
+    
+    assert len(runs) == 1
+    assert any(b'"cached":true' in chunk for chunk in repeat)
+    assert agent._inflight == {}
+
+
+def test_agent_cache_survives_restart(tmp_path):
+    """Test cached classifications saved at shutdown are restored by the next agent"""
+    from agent.cache import SemanticCache
+    
+    classification = {"summary": "Password reset", "category": "Login", "severity": "Low",
+                      "issue_type": "known_issue", "next_action": "Attach KB article ISSUE-115"}
+    
+    agent = TriageAgent()
+    agent.cache_path = str(tmp_path / "triage_cache.json")
+    agent._cache_classification([1.0, 0.0], classification, text_key=SemanticCache.text_key("reset my password"))
+    agent.save_cache()
+    
+    restarted = TriageAgent()
+    restarted.cache_path = agent.cache_path
+    restarted.load_cache()
+    
+    assert restarted.cache.get([0.99, 0.01])[0] == classification
+    assert restarted.cache.get_exact(SemanticCache.text_key("Reset my password"))[0] == classification
+
+
+@pytest.mark.asyncio
+async def test_agent_triage_stream_waits_after_interrupt():
+    """Test a clarifying question ends the stream waiting for the user"""
+    from langchain_core.messages import AIMessage
+    import agent.graph as graph_module
+    import agent.orchestrator as orchestrator_module
+    
+    async def fake_llm(llm, messages):
+        return AIMessage(content=json.dumps({
+            "summary": "", "category": "Bug", "severity": "Low", "issue_type": "new_issue",
+            "next_action": "", "needs_more_info": True, "clarifying_question": "What is broken?"
+        }))
+    
+    with patch.object(graph_module, "call_llm_with_retry", fake_llm), \
+            patch.object(orchestrator_module.kb, "aembed", return_value=[0.0] * 1536), \
+            patch.object(orchestrator_module.kb, "asearch", return_value=[]):
+        events = [orjson.loads(line) async for line in TriageAgent().triage_stream("help")]
+    
+    assert [e for e in events if e["type"] == "interrupt"][0]["question"] == "What is broken?"
+    assert events[-1]["message"] == "Waiting for user response..."
+
+
+def test_ndjson_events_encode_numpy_values():
+    """Test stream events are single NDJSON lines and accept NumPy scores"""
+    import numpy as np
+    from agent.orchestrator import _ndjson
+    
+    line = _ndjson({"type": "kb_hits", "scores": np.array([0.5, 0.25], dtype=np.float32), "top": np.float32(0.5)})
+    
+    assert line.endswith(b"\n") and line.count(b"\n") == 1
+    assert orjson.loads(line) == {"type": "kb_hits", "scores": [0.5, 0.25], "top": 0.5}
+
+
+def test_ndjson_events_reassembles_lines_split_across_chunks():
+    """Test the test suite's NDJSON reader handles events split between reads"""
+    from unittest.mock import Mock
+    
+    response = Mock()
+    response.iter_bytes.return_value = iter([b'{"type":"status"}\n{"type":', b'"field"}\n\n{"type":"end"}'])
+    
+    assert _ndjson_events(response) == [{"type": "status"}, {"type": "field"}, {"type": "end"}]
+
+
+@pytest.mark.asyncio
+async def test_agent_drain_reports_graph_errors():
+    """Test a failing graph run still ends the stream with an error event"""
+    import asyncio
+    from agent.orchestrator import _STREAM_END
+    
+    async def failing_events():
+        yield b'{"type":"node_start"}\n'
+        raise RuntimeError("graph failed")
+    
+    queue = asyncio.Queue()
+    await TriageAgent._drain(failing_events(), queue)
+    
+    items = [queue.get_nowait() for _ in range(queue.qsize())]
+    assert items[0] == b'{"type":"node_start"}\n'
+    assert orjson.loads(items[1]) == {"type": "error", "message": "graph failed"}
+    assert items[2] is _STREAM_END
+
+
+@pytest.mark.asyncio
+async def test_classify_prompt_prefix_is_constant():
+    """Test the triage instructions are sent unchanged ahead of the ticket"""
+    import agent.graph as graph_module
+    from langchain_core.messages import AIMessage, HumanMessage
+    from agent.prompts import TRIAGE_SYSTEM_PROMPT
+    
+    sent = []
+    
+    async def fake_llm(llm, messages):
+        sent.append(messages)
+        return AIMessage(content="")
+    
+    with patch.object(graph_module, "call_llm_with_retry", fake_llm):
+        for description in ["Login not working", "App is slow"]:
+            await graph_module.classify_node({
+                "messages": [HumanMessage(content=description)],
+                "kb_results": "No matching known issues found in the knowledge base."
+            })
+    
+    assert [messages[0].content for messages in sent] == [TRIAGE_SYSTEM_PROMPT] * 2
+    assert "Login not working" in sent[0][1].content
+
+
+def test_checkpointer_keeps_most_recent_threads():
+    """Test the checkpointer drops the oldest threads beyond its limit"""
+    from agent.graph import BoundedMemorySaver, build_graph
+    
+    graph = build_graph()
+    graph.checkpointer = BoundedMemorySaver(max_threads=2)
+    
+    for thread_id in ["t1", "t2", "t3"]:
+        graph.update_state({"configurable": {"thread_id": thread_id}}, {"additional_details": thread_id})
+    
+    assert list(graph.checkpointer.storage) == ["t2", "t3"]
+    assert not graph.get_state({"configurable": {"thread_id": "t1"}}).values
+    assert graph.get_state({"configurable": {"thread_id": "t3"}}).values["additional_details"] == "t3"
+
+
+def test_classify_prompt_prefix_is_long_enough_to_cache():
+    """Test the system prompt stays above OpenAI's 1024-token prompt-caching threshold"""
+    tiktoken = pytest.importorskip("tiktoken")
+    from agent.prompts import TRIAGE_SYSTEM_PROMPT
+    
+    try:
+        # The gpt-4o family's encoding; tiktoken downloads it on first use
+        encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        pytest.skip(f"o200k_base encoding unavailable: {e}")
+    
+    assert len(encoding.encode(TRIAGE_SYSTEM_PROMPT)) >= 1024
+
+
+
 # ============================================================================
-# Edge Case Tests
+# Knowledge Base Tests
 # ============================================================================
 
-def test_triage_with_special_characters():
-    """Test triage with special characters in description"""
-    payload = {"description": "Error: <script>alert('test')</script> & symbols @#$%"}
-    response = client.post("/triage/stream", json=payload)
+def _bag_of_words_embedding(text):
+    """Deterministic stand-in for OpenAI embeddings in KB tests"""
+    vector = [0.0] * 64
+    for word in text.lower().split():
+        vector[sum(map(ord, word)) % 64] += 1.0
+    return vector
+
+
+def _bag_of_words_embeddings(texts, model=None):
+    return [_bag_of_words_embedding(text) for text in texts]
+
+
+def test_kb_search_ranks_closest_entry_first():
+    """Test KB search returns the most similar known issue first"""
+    from kb.search import KnowledgeBase
     
-    assert response.status_code == 200
+    kb = KnowledgeBase()
+    with patch.object(kb, "_create_embeddings", side_effect=_bag_of_words_embeddings):
+        results = kb.search("checkout 500 error on mobile payment", top_k=3)
+    
+    assert len(results) == 3
+    assert results[0]["id"] == "ISSUE-101"
+    assert results[0]["score"] >= results[1]["score"] >= results[2]["score"]
 
 
-def test_triage_with_unicode():
-    """Test triage with unicode characters"""
-    payload = {"description": "用户登录失败 - Login failure with Chinese characters 你好"}
-    response = client.post("/triage/stream", json=payload)
+def test_kb_search_builds_index_once():
+    """Test KB entries are embedded in one request and reused across searches"""
+    from kb.search import KnowledgeBase
     
-    assert response.status_code == 200
+    kb = KnowledgeBase()
+    with patch.object(kb, "_create_embeddings", side_effect=_bag_of_words_embeddings) as mock_embed:
+        kb.search("login password", top_k=3)
+        calls_after_first_search = mock_embed.call_count
+        # One request for all KB entries, one for the query
+        assert calls_after_first_search == 2
+        kb.search("slow dashboard", top_k=3)
+    
+    # Only the new query needs an embedding on the second search
+    assert mock_embed.call_count == calls_after_first_search + 1
 
 
-def test_triage_with_line_breaks():
-    """Test triage with line breaks in description"""
-    payload = {"description": "Issue description:\n\n1. Step one\n2. Step two\n\nError occurred"}
-    response = client.post("/triage/stream", json=payload)
+def test_kb_is_shared_process_wide():
+    """Test every user of the KB gets the same instance and index"""
+    from kb.search import get_knowledge_base
+    import agent.tools as tools_module
+    import agent.orchestrator as orchestrator_module
     
-    assert response.status_code == 200
+    assert get_knowledge_base() is get_knowledge_base()
+    assert tools_module.kb is get_knowledge_base()
+    assert orchestrator_module.kb is get_knowledge_base()
 
 
-def test_triage_at_max_length():
-    """Test triage with description at exactly max length"""
-    payload = {"description": "A" * 5000}  # Exactly MAX_DESCRIPTION_LENGTH
-    response = client.post("/triage/stream", json=payload)
+def test_kb_entries_loaded_once():
+    """Test KB entries are read from disk once and only when first needed"""
+    from kb.search import KnowledgeBase
     
-    assert response.status_code == 200
+    kb = KnowledgeBase()
+    with patch.object(kb, "load_kb", wraps=kb.load_kb) as mock_load:
+        assert mock_load.call_count == 0
+        assert kb.entries is kb.entries
+    
+    assert mock_load.call_count == 1
+
+
+def test_kb_embeddings_persist_across_instances(tmp_path):
+    """Test KB embeddings are saved to disk and reused after a restart"""
+    import numpy as np
+    from kb.search import KnowledgeBase
+    
+    first = KnowledgeBase()
+    first.embeddings_dir = str(tmp_path)
+    with patch.object(first, "_create_embeddings", side_effect=_bag_of_words_embeddings):
+        expected = first.search("password reset link expired", top_k=3)
+    
+    assert len(list(tmp_path.glob("kb_embeddings_*.npy"))) == 1
+    
+    second = KnowledgeBase()
+    second.embeddings_dir = str(tmp_path)
+    with patch.object(second, "_create_embeddings", side_effect=_bag_of_words_embeddings) as mock_embed:
+        assert second.search("password reset link expired", top_k=3) == expected
+    
+    # Only the query was embedded; the KB matrix came from disk
+    assert mock_embed.call_count == 1
+    assert isinstance(second._index.vectors, np.memmap)
+
+
+def test_embedding_cache_survives_restart(tmp_path):
+    """Test embeddings are read back from disk, scoped by model, with a bounded memory layer"""
+    from kb.embedding_cache import EmbeddingCache
+    
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = EmbeddingCache(max_size=2, path=path)
+    cache.put_many("model-a", [("one", [1.0, 0.5]), ("two", [0.0, 2.0]), ("three", [3.0, 0.0])])
+    
+    assert len(cache) == 2
+    
+    restarted = EmbeddingCache(max_size=2, path=path)
+    assert restarted.get_many("model-a", ["one", "three", "four"]) == {"one": [1.0, 0.5], "three": [3.0, 0.0]}
+    assert restarted.get_many("model-b", ["one"]) == {}
+
+
+def test_kb_search_reuses_cached_query_embeddings():
+    """Test a repeated query is embedded once"""
+    from kb.search import KnowledgeBase
+    
+    kb = KnowledgeBase()
+    with patch.object(kb, "_create_embeddings", side_effect=_bag_of_words_embeddings) as mock_embed:
+        kb.search("invoice charged twice", top_k=3)
+        kb.search("invoice charged twice", top_k=3)
+    
+    # Once for the KB entries, once for the query
+    assert mock_embed.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_merges_concurrent_requests():
+    """Test concurrent embeds share one API request and each get their own vector"""
+    import asyncio
+    from kb.embedding_batcher import EmbeddingBatcher
+    
+    requests = []
+    
+    async def embed_many(texts, model):
+        requests.append((model, texts))
+        return _bag_of_words_embeddings(texts)
+    
+    batcher = EmbeddingBatcher(embed_many, max_batch=8, max_wait=0.01)
+    texts = ["login fails", "invoice wrong", "login fails", "app is slow"]
+    embeddings = await asyncio.gather(*(batcher.embed(text, "model-a") for text in texts))
+    
+    assert requests == [("model-a", ["login fails", "invoice wrong", "app is slow"])]
+    assert embeddings == _bag_of_words_embeddings(texts)
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_fails_every_caller_on_a_short_response():
+    """Test a response with fewer embeddings than texts fails each caller instead of leaving some waiting"""
+    import asyncio
+    from kb.embedding_batcher import EmbeddingBatcher
+    
+    async def embed_many(texts, model):
+        return _bag_of_words_embeddings(texts)[:1]
+    
+    batcher = EmbeddingBatcher(embed_many, max_batch=8, max_wait=0.01)
+    results = await asyncio.wait_for(
+        asyncio.gather(*(batcher.embed(text, "model-a") for text in ["login fails", "app is slow"]),
+                       return_exceptions=True),
+        timeout=1
+    )
+    
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_kb_aembed_fills_the_search_cache():
+    """Test async embedding caches the query for the following KB search"""
+    from kb.search import KnowledgeBase
+    
+    kb = KnowledgeBase()
+    
+    async def embed_many(texts, model):
+        return _bag_of_words_embeddings(texts)
+    
+    with patch.object(kb.batcher, "embed_many", side_effect=embed_many):
+        embedding = await kb.aembed("invoice charged twice")
+    
+    assert embedding == _bag_of_words_embedding("invoice charged twice")
+    with patch.object(kb, "_create_embeddings", side_effect=_bag_of_words_embeddings) as mock_embed:
+        kb.search("invoice charged twice", top_k=3)
+    
+    # Only the KB entries needed embedding
+    assert mock_embed.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_kb_asearch_matches_search():
+    """Test async search ranks the same way as sync search"""
+    from kb.search import KnowledgeBase
+    
+    kb = KnowledgeBase()
+    
+    async def embed_many(texts, model):
+        return _bag_of_words_embeddings(texts)
+    
+    with patch.object(kb, "_create_embeddings", side_effect=_bag_of_words_embeddings), \
+            patch.object(kb.batcher, "embed_many", side_effect=embed_many):
+        results = await kb.asearch("checkout 500 error on mobile payment", top_k=3)
+        assert results == kb.search("checkout 500 error on mobile payment", top_k=3)
+    
+    assert results[0]["id"] == "ISSUE-101"
+
+
+def test_kb_hot_reload_picks_up_file_changes(tmp_path):
+    """Test an edited KB file is reloaded on the next search when hot reload is on"""
+    import os
+    from kb.search import KnowledgeBase
+    
+    entry = {"id": "ISSUE-900", "title": "Login button missing", "category": "Login",
+             "symptoms": ["login button"], "recommended_action": "Clear cache"}
+    kb_path = tmp_path / "kb.json"
+    kb_path.write_text(json.dumps([entry]))
+    
+    kb = KnowledgeBase()
+    kb.kb_path = str(kb_path)
+    kb.hot_reload = True
+    with patch.object(kb, "_create_embeddings", side_effect=_bag_of_words_embeddings):
+        assert kb.search("login button", top_k=1)[0]["title"] == "Login button missing"
+        snapshot = kb.snapshot
+        
+        kb_path.write_text(json.dumps([dict(entry, title="Login button hidden")]))
+        os.utime(kb_path, (0, os.stat(kb_path).st_mtime + 10))
+        
+        assert kb.search("login button", top_k=1)[0]["title"] == "Login button hidden"
+    
+    assert kb.snapshot == snapshot + 1
+    assert kb.entry_texts == ["Login button hidden login button"]
+
+
+def test_kb_entry_texts_built_once_per_load():
+    """Test entry texts are built at load time, not on every search"""
+    from kb.search import KnowledgeBase
+    
+    kb = KnowledgeBase()
+    kb.entries = [
+        {"id": "A", "title": "Crash on start", "symptoms": ["app crashes"]},
+        {"id": "B", "title": "Blank page", "symptoms": []}
+    ]
+    
+    assert kb.entry_texts == ["Crash on start app crashes", "Blank page"]
+    with patch.object(kb, "_build_entry_text") as build:
+        assert kb.entry_texts is kb.entry_texts
+    build.assert_not_called()
+
+
+def test_kb_quantized_scores_match_cosine():
+    """Test int8-quantized KB scores stay close to float cosine similarity"""
+    import numpy as np
+    from kb.search import KnowledgeBase
+    
+    vectors = KnowledgeBase._normalize(np.random.default_rng(0).normal(size=(20, 1536)).astype(np.float32))
+    quantized, scales = KnowledgeBase._quantize(vectors)
+    
+    assert quantized.dtype == np.int8
+    
+    exact = vectors @ vectors[0]
+    query_i8, query_scale = KnowledgeBase._quantize(vectors[0])
+    approx = np.matmul(quantized, query_i8, dtype=np.int32) / (scales * query_scale)
+    
+    assert np.allclose(approx, exact, atol=0.02)
+
+
+def test_kb_float32_scan_matches_int8_scan():
+    """Test KB_EMBEDDING_DTYPE=float32 skips quantization and ranks the same"""
+    from kb.search import KnowledgeBase
+    
+    int8_kb = KnowledgeBase()
+    float32_kb = KnowledgeBase()
+    float32_kb.embedding_dtype = "float32"
+    
+    with patch.object(int8_kb, "_create_embeddings", side_effect=_bag_of_words_embeddings), \
+            patch.object(float32_kb, "_create_embeddings", side_effect=_bag_of_words_embeddings):
+        expected = int8_kb.search("checkout 500 error on mobile payment", top_k=3)
+        assert float32_kb.search("checkout 500 error on mobile payment", top_k=3) == expected
+    
+    assert float32_kb._index.quantized is None
+
+
+def test_kb_top_k_orders_best_first_with_ties_in_kb_order():
+    """Test the argpartition top-k matches a full stable sort"""
+    import numpy as np
+    from kb.search import KnowledgeBase
+    
+    scores = np.array([0.2, 0.9, 0.5, 0.9, 0.1, 0.5])
+    
+    assert KnowledgeBase._top_k(scores, 3).tolist() == [1, 3, 2]
+    assert KnowledgeBase._top_k(scores, 10).tolist() == [1, 3, 2, 5, 0, 4]
+    assert KnowledgeBase._top_k(scores, 0).tolist() == []
+
+
+def test_kb_vector_search_reranks_with_float32():
+    """Test the int8 shortlist is reordered by exact float32 similarity"""
+    import numpy as np
+    from kb.search import KnowledgeBase
+    
+    kb = KnowledgeBase()
+    with patch.object(kb, "_create_embeddings", side_effect=_bag_of_words_embeddings):
+        index = kb._get_index()
+        query = KnowledgeBase._normalize(np.asarray(kb.embed("dashboard loads slowly"), dtype=np.float32))
+    
+    ranking = kb._vector_search(index, query)
+    exact = index.vectors @ query
+    
+    assert list(exact[ranking]) == sorted(exact[ranking], reverse=True)
+    assert ranking[0] == int(np.argmax(exact))
+
+
+def test_kb_search_uses_keywords_without_embeddings():
+    """Test BM25 keyword ranking still finds the right entry if embeddings fail"""
+    from kb.search import KnowledgeBase
+    
+    kb = KnowledgeBase()
+    with patch.object(kb, "_create_embeddings", side_effect=RuntimeError("offline")):
+        results = kb.search("Exporting my data to CSV <script> \"quotes\" OR", top_k=3)
+    
+    assert results[0]["id"] == "ISSUE-106"
+    assert results[0]["score"] == 0.0
+
+
+def test_kb_context_block_is_memoized():
+    """Test repeated KB hits reuse the rendered context block"""
+    from agent.tools import format_kb_results, _format_kb_hits
+    
+    hits = [{"id": "ISSUE-102", "title": "Login fails with incorrect password error",
+             "category": "Login", "score": 0.734, "recommended_action": "Send password reset link"}]
+    
+    first = format_kb_results(hits)
+    hits_before = _format_kb_hits.cache_info().hits
+    # Same hit with a score that renders identically
+    second = format_kb_results([dict(hits[0], score=0.7341)])
+    
+    assert second is first
+    assert _format_kb_hits.cache_info().hits == hits_before + 1
+    assert "ISSUE-102" in first and "Similarity: 0.73" in first
+    
+    # Hits that aren't in the KB are still rendered
+    unknown = format_kb_results([dict(hits[0], id="ISSUE-999")])
+    assert "ISSUE-999" in unknown
+
+
+def test_kb_context_block_without_hits():
+    """Test an empty KB search tells the LLM nothing matched"""
+    from agent.tools import format_kb_results
+    from agent.prompts import format_kb_block
+    
+    assert format_kb_results([]) == "No matching known issues found in the knowledge base."
+    assert format_kb_block(hit for hit in ()) == "No matching known issues found in the knowledge base."
+
+
+# ============================================================================
+# Utility Tests
+# ============================================================================
+
+def test_parse_completed_fields_from_partial_json():
+    """Test only fully streamed fields are extracted from partial tool arguments"""
+    from agent.utils import parse_completed_fields
+    
+    assert parse_completed_fields("") == {}
+    assert parse_completed_fields('{"summary": "Card fails", "categ') == {"summary": "Card fails"}
+    assert parse_completed_fields('{"summary": "Card fa') == {}
+    # A number is only complete once its separator arrives
+    assert parse_completed_fields('{"needs_more_info": false, "score": 0.5') == {"needs_more_info": False}
+    assert parse_completed_fields('{"a": "x", "b": {"c": 1}}') == {"a": "x", "b": {"c": 1}}
+
+
+def test_streaming_field_parser_emits_each_field_once():
+    """Test the incremental parser reports each field as soon as it completes"""
+    from agent.utils import StreamingFieldParser
+    
+    parser = StreamingFieldParser()
+    text = '{"summary": "Card \\"update\\" fails", "category": "Billing", "severity": "High"}'
+    
+    completed = []
+    for i in range(0, len(text), 7):
+        completed.extend(parser.feed(text[i:i + 7]).items())
+    
+    assert completed == [
+        ("summary", 'Card "update" fails'),
+        ("category", "Billing"),
+        ("severity", "High")
+    ]
+    assert parser.feed("") == {}
+
+
+def test_retry_with_backoff_uses_jittered_delays():
+    """Test retries sleep a random time bounded by the exponential backoff delay"""
+    import httpx
+    from openai import APIConnectionError
+    from agent.utils import retry_with_backoff
+    
+    attempts = []
+    
+    @retry_with_backoff(max_retries=3, initial_delay=1.0, backoff_factor=2.0)
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise APIConnectionError(request=httpx.Request("POST", "https://api.openai.com"))
+        return "ok"
+    
+    with patch("agent.utils.time.sleep") as mock_sleep:
+        assert flaky() == "ok"
+    
+    delays = [call.args[0] for call in mock_sleep.call_args_list]
+    assert len(delays) == 2
+    assert 0 <= delays[0] <= 1.0
+    assert 0 <= delays[1] <= 2.0
+
+
+def test_retry_with_backoff_reads_settings_when_called():
+    """Test decorator defaults come from the settings at call time, not import time"""
+    import httpx
+    from openai import APIConnectionError
+    from agent.utils import retry_with_backoff, LLMError
+    from app.config import get_settings
+    
+    attempts = []
+    
+    @retry_with_backoff()
+    def unreachable():
+        attempts.append(1)
+        raise APIConnectionError(request=httpx.Request("POST", "https://api.openai.com"))
+    
+    no_retries = get_settings().model_copy(update={"MAX_RETRIES": 0})
+    with patch("agent.utils.get_settings", return_value=no_retries), \
+            patch("agent.utils.time.sleep") as mock_sleep:
+        with pytest.raises(LLMError):
+            unreachable()
+    
+    assert len(attempts) == 1
+    mock_sleep.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_retry_with_backoff_warns_when_blocking_the_event_loop(caplog):
+    """Test a sync retry sleeping on the event loop thread is reported"""
+    import httpx
+    from openai import APIConnectionError
+    from agent.utils import retry_with_backoff
+    
+    attempts = []
+    
+    @retry_with_backoff(max_retries=1, initial_delay=1.0)
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 2:
+            raise APIConnectionError(request=httpx.Request("POST", "https://api.openai.com"))
+        return "ok"
+    
+    with patch("agent.utils.time.sleep"):
+        assert flaky() == "ok"
+    
+    assert "on the event loop thread" in caplog.text
+
+
+def test_retry_with_backoff_honors_retry_after():
+    """Test a rate limit's Retry-After header replaces the computed backoff"""
+    import httpx
+    from openai import RateLimitError
+    from agent.utils import retry_with_backoff
+    
+    attempts = []
+    response = httpx.Response(
+        429,
+        headers={"retry-after-ms": "250"},
+        request=httpx.Request("POST", "https://api.openai.com")
+    )
+    
+    @retry_with_backoff(max_retries=2, initial_delay=5.0, backoff_factor=2.0)
+    def limited():
+        attempts.append(1)
+        if len(attempts) < 2:
+            raise RateLimitError("rate limited", response=response, body=None)
+        return "ok"
+    
+    with patch("agent.utils.time.sleep") as mock_sleep:
+        assert limited() == "ok"
+    
+    mock_sleep.assert_called_once_with(0.25)
+
+
+def test_handle_llm_error_picks_most_specific_handler():
+    """Test LLM errors map to the message of their most specific class"""
+    import httpx
+    from openai import APIConnectionError, APITimeoutError, RateLimitError
+    from agent.utils import LLMError, handle_llm_error
+    
+    request = httpx.Request("POST", "https://api.openai.com")
+    response = httpx.Response(429, headers={"retry-after": "7"}, request=request)
+    
+    class CustomLLMError(LLMError):
+        pass
+    
+    assert handle_llm_error(RateLimitError("rate limited", response=response, body=None)) == {
+        "error": "rate_limit",
+        "message": "API rate limit exceeded. Please try again in a moment.",
+        "retry_after": 7.0
+    }
+    assert handle_llm_error(APITimeoutError(request=request))["error"] == "timeout"
+    assert handle_llm_error(APIConnectionError(request=request))["error"] == "connection"
+    assert handle_llm_error(CustomLLMError("bad output")) == {"error": "llm_error", "message": "bad output"}
+    assert handle_llm_error(ValueError("boom"))["error"] == "unknown"
+
+
+def test_rate_limiter_spaces_requests_over_the_window():
+    """Test requests beyond the per-minute limit wait for the oldest to leave the window"""
+    from agent.rate_limiter import RateLimiter
+    
+    limiter = RateLimiter(rpm_limit=2)
+    with patch("agent.rate_limiter.time.monotonic", return_value=100.0):
+        assert limiter.reserve() == 0
+        assert limiter.reserve() == 0
+        assert limiter.reserve() == 60.0
+
+
+def test_rate_limiter_waits_for_reset_when_headers_run_low():
+    """Test a nearly exhausted provider budget holds requests until its reset"""
+    import httpx
+    from agent.rate_limiter import RateLimiter
+    
+    limiter = RateLimiter(threshold=0.1)
+    with patch("agent.rate_limiter.time.monotonic", return_value=100.0):
+        limiter.update(httpx.Headers({
+            "x-ratelimit-limit-requests": "500",
+            "x-ratelimit-remaining-requests": "400",
+            "x-ratelimit-reset-requests": "1m30s"
+        }))
+        assert limiter.reserve() == 0
+        
+        limiter.update(httpx.Headers({
+            "x-ratelimit-limit-requests": "500",
+            "x-ratelimit-remaining-requests": "20",
+            "x-ratelimit-reset-requests": "250ms"
+        }))
+        assert limiter.reserve() == pytest.approx(0.25)
+
+
+def test_endpoint_rate_limiters_keep_chat_and_embeddings_apart():
+    """Test each OpenAI endpoint on the shared client gets its own limiter"""
+    import httpx
+    from agent.rate_limiter import EndpointRateLimiters
+    
+    limiters = EndpointRateLimiters(rpm_limit=1)
+    chat = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    embeddings = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+    
+    assert limiters.for_request(chat) is limiters.get("chat/completions")
+    with patch("agent.rate_limiter.time.monotonic", return_value=100.0):
+        assert limiters.for_request(chat).reserve() == 0
+        assert limiters.for_request(embeddings).reserve() == 0
+        assert limiters.for_request(chat).reserve() == 60.0
+
+
+def test_llm_and_kb_share_one_openai_client():
+    """Test chat and embedding calls go through the same pooled OpenAI clients"""
+    from agent.clients import get_openai, get_async_openai
+    from agent.graph import get_models
+    from kb.search import get_knowledge_base
+    
+    kb = get_knowledge_base()
+    llm = get_models().classify.bound
+    
+    assert kb.async_client is get_async_openai()
+    assert kb.client is get_openai()
+    assert llm.root_async_client is get_async_openai()
+    assert llm.async_client is get_async_openai().chat.completions
+
+
+@pytest.mark.asyncio
+async def test_close_openai_clients_rebuilds_shared_clients():
+    """Test closing the shared clients at shutdown leaves fresh ones for the next startup"""
+    from agent.clients import get_openai, get_async_openai, close_openai_clients
+    from agent.graph import get_models
+    from kb.search import get_knowledge_base
+    
+    kb = get_knowledge_base()
+    old_client, old_async_client = get_openai(), get_async_openai()
+    
+    await close_openai_clients()
+    
+    assert old_client.is_closed() and old_async_client.is_closed()
+    assert get_async_openai() is not old_async_client
+    assert not get_async_openai().is_closed()
+    assert not get_openai().is_closed()
+    assert kb.async_client is get_async_openai()
+    assert kb.client is get_openai()
+    assert get_models().classify.bound.root_async_client is get_async_openai()
+
+
+@pytest.mark.asyncio
+async def test_aimd_controller_halves_on_failure_and_grows_on_success():
+    """Test the concurrency cap backs off on overload errors and recovers on fast calls"""
+    import httpx
+    from openai import APIConnectionError
+    from agent.backpressure import AIMDController
+    
+    controller = AIMDController(min_limit=1, max_limit=4, target_latency=1.0)
+    
+    with pytest.raises(APIConnectionError):
+        async with controller.admit():
+            raise APIConnectionError(request=httpx.Request("POST", "https://api.openai.com"))
+    assert controller.limit == 2.0
+    
+    async with controller.admit():
+        pass
+    assert controller.limit == 2.5
+    assert controller.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_aimd_controller_queues_calls_over_the_cap():
+    """Test calls beyond the cap wait until a slot is released"""
+    import asyncio
+    from agent.backpressure import AIMDController
+    
+    controller = AIMDController(min_limit=1, max_limit=1)
+    release = asyncio.Event()
+    order = []
+    
+    async def call(name):
+        async with controller.admit():
+            order.append(name)
+            await release.wait()
+    
+    first = asyncio.create_task(call("first"))
+    second = asyncio.create_task(call("second"))
+    await asyncio.sleep(0)
+    assert order == ["first"]
+    
+    release.set()
+    await asyncio.gather(first, second)
+    assert order == ["first", "second"]
+    assert controller.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_aimd_controller_cancelled_waiter_after_release():
+    """Test cancelling a queued call stays a CancelledError when a release ran before it resumed"""
+    import asyncio
+    from agent.backpressure import AIMDController
+    
+    controller = AIMDController(min_limit=1, max_limit=1)
+    await controller._acquire()
+    waiting = asyncio.create_task(controller._acquire())
+    await asyncio.sleep(0)
+    
+    waiting.cancel()
+    # The slot frees up before the cancelled task gets to run
+    controller._release(None, failed=False)
+    
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert controller.in_flight == 0
+    assert not controller._waiters
+
+
+# ============================================================================
+# Cache Tests
+# ============================================================================
+
+def test_semantic_cache_hit_and_miss():
+    """Test semantic cache returns results only for similar embeddings"""
+    from agent.cache import SemanticCache
+    
+    cache = SemanticCache(max_size=10, ttl=60, threshold=0.97)
+    cache.put([1.0, 0.0, 0.0], {"category": "Login"})
+    
+    assert cache.get([0.99, 0.05, 0.0]) == {"category": "Login"}
+    assert cache.get([0.0, 1.0, 0.0]) is None
+
+
+def test_semantic_cache_ignores_zero_embeddings():
+    """Test zero vectors from failed embedding calls are never cached or matched"""
+    from agent.cache import SemanticCache
+    
+    cache = SemanticCache()
+    cache.put([0.0, 0.0], {"category": "Bug"})
+    
+    assert len(cache) == 0
+    assert cache.get([0.0, 0.0]) is None
+
+
+def test_semantic_cache_lru_eviction_and_ttl():
+    """Test semantic cache evicts least recently used and expired entries"""
+    from agent.cache import SemanticCache
+    
+    cache = SemanticCache(max_size=2, ttl=60)
+    cache.put([1.0, 0.0, 0.0], "a")
+    cache.put([0.0, 1.0, 0.0], "b")
+    cache.get([1.0, 0.0, 0.0])  # "a" is now most recently used
+    cache.put([0.0, 0.0, 1.0], "c")
+    
+    assert cache.get([0.0, 1.0, 0.0]) is None
+    assert cache.get([1.0, 0.0, 0.0]) == "a"
+    
+    expired = SemanticCache(ttl=0)
+    expired.put([1.0, 0.0], "stale")
+    assert expired.get([1.0, 0.0]) is None
+
+
+def test_semantic_cache_exact_tier():
+    """Test exact text lookups ignore case and spacing, and forget evicted entries"""
+    from agent.cache import SemanticCache
+    
+    cache = SemanticCache(max_size=1)
+    cache.put([1.0, 0.0], "a", text_key=SemanticCache.text_key("Login  fails"))
+    
+    assert cache.get_exact(SemanticCache.text_key("login fails")) == "a"
+    assert cache.get_exact(SemanticCache.text_key("login works")) is None
+    
+    cache.put([0.0, 1.0], "b")
+    assert cache.get_exact(SemanticCache.text_key("login fails")) is None
+    assert cache._by_text == {}
+
+
+# ============================================================================
+# Edge Case Tests
+# ============================================================================
+
+EDGE_CASE_DESCRIPTIONS = {
+    "special_characters": "Error: <script>alert('test')</script> & symbols @#$%",
+    "unicode": "用户登录失败 - Login failure with Chinese characters 你好",
+    "line_breaks": "Issue description:\n\n1. Step one\n2. Step two\n\nError occurred",
+    "max_length": _MAX_DESC,
+}
+
+
+@pytest.mark.asyncio
+async def test_triage_edge_case_descriptions(async_client):
+    """Test triage with special characters, unicode, line breaks and a max-length description"""
+    import asyncio
+    
+    # Streams run concurrently, so their LLM round trips overlap instead of adding up
+    limit = asyncio.Semaphore(8)
+    
+    async def post(description):
+        async with limit:
+            return await async_client.post("/triage/stream", json={"description": description})
+    
+    responses = await asyncio.gather(*(post(description) for description in EDGE_CASE_DESCRIPTIONS.values()))
+    
+    for name, response in zip(EDGE_CASE_DESCRIPTIONS, responses):
+        assert response.status_code == 200, name
 
 
 @pytest.mark.slow
-def test_triage_billing_issue(mock_async_openai_client):
+def test_triage_billing_issue(client, mock_async_openai_client):
     """Test billing issue classification"""
     payload = {"description": "Cannot update my credit card for subscription payment"}
     response = client.post("/triage/stream", json=payload)
@@ -247,10 +1524,7 @@ def test_triage_billing_issue(mock_async_openai_client):
     assert response.status_code == 200
     
     # Check classification contains billing-related info
-    events = []
-    for line in response.iter_lines():
-        if line:
-            events.append(json.loads(line))
+    events = _ndjson_events(response)
     
     classification_events = [e for e in events if e.get("type") == "classification_complete"]
     if classification_events:
@@ -270,4 +1544,16 @@ def test_environment_configuration():
     assert settings.ENVIRONMENT in ["dev", "prod", "test"]
     assert settings.MAX_RETRIES > 0
     assert settings.PORT > 0
-    assert settings.MAX_DESCRIPTION_LENGTH > 0
\ No newline at end of file
+    assert settings.MAX_DESCRIPTION_LENGTH > 0
+
+
+def test_settings_are_built_once_and_frozen():
+    """Test settings are parsed once per process and can't be changed afterwards"""
+    from pydantic import ValidationError
+    from app.config import get_settings
+    
+    settings = get_settings()
+    
+    assert get_settings() is settings
+    with pytest.raises(ValidationError):
+        settings.MAX_RETRIES = 10
\ No newline at end of file